@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+import random
+import time
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+
+from mucache.chunk_sizer import ChunkSizer
+from mucache.file_chunks import FileChunks
+
+MIB = 1024 * 1024
+
+
+def create_arg_parser():
+    p = ArgumentParser(
+        description="Compare fixed and adaptive chunk sizes against a simulated remote.",
+        prog="python -m benchmarks.chunk_size",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    p.add_argument('--latency-ms', default=5.0, type=float,
+                   help='latency of every remote read')
+    p.add_argument('--bandwidth-mib', default=100.0, type=float,
+                   help='bandwidth of the remote in mebibytes per second')
+    p.add_argument('--sizes-mib', default=[1, 16, 256], type=int, nargs='+',
+                   help='sizes of the files to cache')
+    p.add_argument('--random-reads', default=50, type=int,
+                   help='number of random reads of 128 KiB in every file')
+    p.add_argument('--fixed-kib', default=256, type=int,
+                   help='chunk size of the fixed strategy in kibibytes')
+    return p
+
+
+class Fd:
+    def fileno(self):
+        return -1
+
+
+class RemoteCopier:
+    # Simulate the copy from a remote with some latency and bandwidth
+    def __init__(self, latency_sec, bandwidth):
+        self._latency_sec = latency_sec
+        self._bandwidth = bandwidth
+        self.n_bytes = 0
+        self.n_reads = 0
+
+    def copy(self, src_fd, dst_fd, offset, size):
+        time.sleep(self._latency_sec + size / self._bandwidth)
+        self.n_bytes += size
+        self.n_reads += 1
+        return size
+
+
+def bench(name, sizer, args):
+    copier = RemoteCopier(args.latency_ms / 1000, args.bandwidth_mib * MIB)
+    for size_mib in args.sizes_mib:
+        size = size_mib * MIB
+
+        chunks = FileChunks(size, chunk_size_bits=sizer.get_bits(size),
+                            copier=copier, chunk_sizer=sizer)
+        start_ts = time.perf_counter()
+        while chunks.cache_next_chunk(Fd(), Fd()):
+            pass
+        cache_sec = time.perf_counter() - start_ts
+
+        chunks = FileChunks(size, chunk_size_bits=sizer.get_bits(size),
+                            copier=copier, chunk_sizer=sizer)
+        copier.n_bytes = 0
+        rnd = random.Random(size)
+        start_ts = time.perf_counter()
+        for _ in range(args.random_reads):
+            chunks.ensure_in_cache(Fd(), Fd(), 128 * 1024, rnd.randrange(size))
+        read_ms = (time.perf_counter() - start_ts) * 1000 / max(args.random_reads, 1)
+
+        print(f"{name:<10} {size_mib:>8} {1 << chunks.chunk_size_bits() >> 10:>10} "
+              f"{cache_sec:>10.2f} {read_ms:>12.2f} {copier.n_bytes / MIB:>12.1f}")
+
+
+def main():
+    args = create_arg_parser().parse_args()
+    fixed_bits = args.fixed_kib.bit_length() - 1 + 10
+
+    print(f"{'strategy':<10} {'size MiB':>8} {'chunk KiB':>10} {'cache sec':>10} "
+          f"{'read ms':>12} {'read MiB':>12}")
+    bench('fixed', ChunkSizer(min_bits=fixed_bits, max_bits=fixed_bits), args)
+    bench('adaptive', ChunkSizer(), args)
+
+
+if __name__ == '__main__':
+    main()
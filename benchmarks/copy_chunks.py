@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+import os
+import os.path
+import tempfile
+import time
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+
+from mucache.chunk_copier import ChunkCopier
+
+MIB = 1024 * 1024
+
+
+def create_arg_parser():
+    p = ArgumentParser(
+        description="Compare the throughput of the methods to copy chunks.",
+        prog="python -m benchmarks.copy_chunks",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    p.add_argument('--size-mib', default=512, type=int,
+                   help='size of the copied file in mebibytes')
+    p.add_argument('--chunk-size-bits', default=18, type=int,
+                   help='size of every copied chunk')
+    p.add_argument('--src', default=None,
+                   help='file to copy, a random one is created if not set')
+    p.add_argument('--tmp-dir', default=None,
+                   help='directory where the copies are written')
+    p.add_argument('--rounds', default=3, type=int,
+                   help='number of times that every method is run')
+    return p
+
+
+def copy_with_file_objects(src_path, dst_path, chunk_size):
+    # The copy made before the chunk copier, through the python buffers
+    with open(src_path, 'rb') as src_fd, open(dst_path, 'rb+') as dst_fd:
+        offset = 0
+        while True:
+            src_fd.seek(offset)
+            dst_fd.seek(offset)
+            size = chunk_size
+            while size > 0:
+                chunk = src_fd.read(size)
+                if not chunk:
+                    return
+                dst_fd.write(chunk)
+                size -= len(chunk)
+            offset += chunk_size
+
+
+def copy_with_copier(copier, src_path, dst_path, chunk_size):
+    src_fd = os.open(src_path, os.O_RDONLY)
+    dst_fd = os.open(dst_path, os.O_RDWR)
+    try:
+        offset = 0
+        while copier.copy(src_fd, dst_fd, offset, chunk_size) == chunk_size:
+            offset += chunk_size
+    finally:
+        os.close(src_fd)
+        os.close(dst_fd)
+
+
+def run(name, fn, size, rounds):
+    best_wall = best_cpu = None
+    for _ in range(rounds):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        fn()
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        best_wall = wall if best_wall is None else min(best_wall, wall)
+        best_cpu = cpu if best_cpu is None else min(best_cpu, cpu)
+    print(f"{name:<16} {size / MIB / best_wall:>10.1f} MiB/s "
+          f"{best_cpu * 1000:>10.1f} ms cpu")
+
+
+def main():
+    args = create_arg_parser().parse_args()
+    chunk_size = 1 << args.chunk_size_bits
+
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp_dir:
+        src_path = args.src
+        if src_path is None:
+            src_path = os.path.join(tmp_dir, 'src')
+            with open(src_path, 'wb') as f:
+                for _ in range(args.size_mib):
+                    f.write(os.urandom(MIB))
+        size = os.path.getsize(src_path)
+
+        dst_path = os.path.join(tmp_dir, 'dst')
+
+        def prepare():
+            with open(dst_path, 'wb') as f:
+                f.truncate(size)
+
+        def bench(name, fn):
+            def prepare_and_run():
+                prepare()
+                fn()
+            run(name, prepare_and_run, size, args.rounds)
+
+        print(f"Copying {size / MIB:.1f} MiB in chunks of {chunk_size // 1024} KiB")
+        bench('read/write', lambda: copy_with_file_objects(src_path, dst_path, chunk_size))
+        for method in ChunkCopier.available_methods():
+            copier = ChunkCopier([method])
+            bench(method, lambda: copy_with_copier(copier, src_path, dst_path, chunk_size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+import random
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+
+from mucache.eviction import POLICIES, create_policy
+
+GIB = 1024 * 1024 * 1024
+
+
+def create_arg_parser():
+    p = ArgumentParser(
+        description="Compare the hit ratio of the eviction policies on a trace.",
+        prog="python -m benchmarks.eviction",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    p.add_argument('--trace', default=None,
+                   help='file with a "<ts> <id> <size>" access by line, '
+                   'a synthetic one is generated if not set')
+    p.add_argument('--cache-gib', default=[60, 120, 180], type=int, nargs='+',
+                   help='cache sizes to simulate in gibibytes')
+    p.add_argument('--days', default=365, type=int,
+                   help='days of the synthetic trace')
+    p.add_argument('--seed', default=0, type=int,
+                   help='seed of the synthetic trace')
+    return p
+
+
+def read_trace(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                ts, id, size = line.split()
+                yield (int(ts), int(id), int(size))
+
+
+def generate_trace(days, seed):
+    # A library of films and series, where some favourite films are
+    # rewatched every week and the series are watched in binge sessions
+    rnd = random.Random(seed)
+    next_id = 0
+    films = []
+    for _ in range(2000):
+        films.append((next_id, rnd.randint(2, 40) * GIB))
+        next_id += 1
+    favourites = rnd.sample(films, 5)
+    seasons = []
+    for _ in range(300):
+        episodes = []
+        episode_size = rnd.randint(300, 2000) * GIB // 1000
+        for _ in range(rnd.randint(6, 24)):
+            episodes.append((next_id, episode_size))
+            next_id += 1
+        seasons.append(episodes)
+
+    trace = []
+    day_sec = 24 * 60 * 60
+    for day in range(days):
+        ts = day * day_sec + 20 * 60 * 60
+        if day % 7 == 0:
+            for id, size in favourites[:2]:
+                trace.append((ts, id, size))
+                ts += 2 * 60 * 60
+        if rnd.random() < 0.5:
+            id, size = rnd.choice(films)
+            trace.append((ts, id, size))
+            ts += 2 * 60 * 60
+        if rnd.random() < 0.3:
+            episodes = rnd.choice(seasons)
+            for id, size in episodes[:rnd.randint(1, len(episodes))]:
+                trace.append((ts, id, size))
+                ts += 45 * 60
+    return trace
+
+
+def simulate(policy_name, capacity, trace):
+    policy = create_policy(policy_name, capacity)
+    sizes = {}
+    counts = {}
+    used_bytes = 0
+    hits = hit_bytes = total_bytes = 0
+    for ts, id, size in trace:
+        counts[id] = counts.get(id, 0) + 1
+        total_bytes += size
+        if id in sizes:
+            hits += 1
+            hit_bytes += size
+            policy.access(id, ts)
+            continue
+        sizes[id] = size
+        used_bytes += size
+        policy.add(id, size, ts, counts[id])
+        while used_bytes > capacity:
+            evicted = policy.pop()
+            if evicted is None:
+                break
+            used_bytes -= sizes.pop(evicted)
+    return (hits / max(len(trace), 1), hit_bytes / max(total_bytes, 1))
+
+
+def main():
+    args = create_arg_parser().parse_args()
+    if args.trace is not None:
+        trace = list(read_trace(args.trace))
+    else:
+        trace = generate_trace(args.days, args.seed)
+
+    print(f"{len(trace)} accesses")
+    print(f"{'policy':<8} {'cache GiB':>10} {'hit ratio':>10} {'byte hit ratio':>15}")
+    for cache_gib in args.cache_gib:
+        for name in sorted(POLICIES):
+            hit_ratio, byte_hit_ratio = simulate(name, cache_gib * GIB, trace)
+            print(f"{name:<8} {cache_gib:>10} {hit_ratio:>10.3f} {byte_hit_ratio:>15.3f}")
+
+
+if __name__ == '__main__':
+    main()
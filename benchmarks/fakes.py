@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import stat
+import tempfile
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+from mucache.cleaner import Cleaner
+from mucache.filesystem import Filesystem
+from mucache.io_scheduler import IOScheduler
+from mucache.storage import SqliteWrapper, Storage
+from mucache.types import Entry
+
+MIB = 1024 * 1024
+GIB = 1024 * 1024 * 1024
+
+
+class FakeRemote(IOScheduler):
+    # Every read of the source files goes through the scheduler, so it's the
+    # place to simulate a remote with some latency and a shared bandwidth
+    def __init__(self, latency_sec, bytes_per_sec, **kwargs):
+        super().__init__(**kwargs)
+        self._latency_sec = latency_sec
+        self._bytes_per_sec = bytes_per_sec
+        self._link_lock = Lock()
+        self._link_free_ts = 0
+
+    @contextmanager
+    def request(self, io_class, n_bytes):
+        with super().request(io_class, n_bytes):
+            with self._link_lock:
+                start_ts = max(time.monotonic(), self._link_free_ts)
+                self._link_free_ts = start_ts + n_bytes / self._bytes_per_sec
+                end_ts = self._link_free_ts + self._latency_sec
+            time.sleep(max(end_ts - time.monotonic(), 0))
+            yield
+
+    def fetched_bytes(self):
+        return sum(s['bytes'] for s in self.stats().values())
+
+
+class FakePowerManager:
+    # The remote is turned off when nobody has used it for a while, and it
+    # takes some time to turn it on again
+    def __init__(self, wake_sec=0, sleep_after_sec=60):
+        self._wake_sec = wake_sec
+        self._sleep_after_sec = sleep_after_sec
+        self._lock = Lock()
+        self._count = 0
+        self._released_ts = None
+        self.wake_ups = 0
+        self.acquires = 0
+
+    def acquire(self):
+        with self._lock:
+            self.acquires += 1
+            self._count += 1
+            if self._count > 1:
+                return
+            now = time.monotonic()
+            if self._released_ts is None \
+                    or now - self._released_ts > self._sleep_after_sec:
+                self.wake_ups += 1
+                wake_sec = self._wake_sec
+            else:
+                wake_sec = 0
+        if wake_sec > 0:
+            time.sleep(wake_sec)
+
+    def release(self):
+        with self._lock:
+            self._count -= 1
+            if self._count == 0:
+                self._released_ts = time.monotonic()
+
+
+class Library:
+    # A source directory with some series of episodes and its database
+    def __init__(self, n_series, n_episodes, episode_bytes, bytes_per_sec):
+        self.path = tempfile.mkdtemp(prefix='mucache-src-')
+        self.paths = []
+        block = os.urandom(MIB)
+        for s in range(n_series):
+            os.mkdir(os.path.join(self.path, f"series{s}"))
+            for e in range(n_episodes):
+                path = f"/series{s}/e{e:02}.mkv"
+                with open(os.path.join(self.path, path[1:]), 'wb') as f:
+                    for offset in range(0, episode_bytes, MIB):
+                        f.write(block[:min(MIB, episode_bytes - offset)])
+                self.paths.append(path)
+        self.episode_bytes = episode_bytes
+        self.duration = int(episode_bytes / bytes_per_sec)
+
+    def create_storage(self):
+        storage = Storage(SqliteWrapper(':memory:'))
+        storage.setup()
+        entries = [Entry(0, -1, '/', '', st_mode=stat.S_IFDIR | 0o755, st_size=0)]
+        ids_by_dir = {}
+        for path in self.paths:
+            dir_path, name = path.rsplit('/', 1)
+            parent_id = ids_by_dir.get(dir_path)
+            if parent_id is None:
+                parent_id = len(entries)
+                ids_by_dir[dir_path] = parent_id
+                entries.append(Entry(parent_id, 0, dir_path, dir_path[1:],
+                                     st_mode=stat.S_IFDIR | 0o755, st_size=0))
+            entries.append(Entry(len(entries), parent_id, path, name,
+                                 duration=self.duration,
+                                 st_mode=stat.S_IFREG | 0o644,
+                                 st_size=self.episode_bytes))
+        storage.replace_entries(entries)
+        return storage
+
+    def remove(self):
+        shutil.rmtree(self.path)
+
+
+class Setup:
+    # A filesystem over the library without FUSE and with an empty cache
+    def __init__(self, library, remote, power_manager, **kwargs):
+        self.cache_path = tempfile.mkdtemp(prefix='mucache-cache-')
+        self.storage = library.create_storage()
+        self.remote = remote
+        self.power_manager = power_manager
+        self.cleaner = Cleaner(self.cache_path, self.storage, 1024 * GIB)
+        self.fs = Filesystem(
+            src_path=library.path,
+            dst_path=self.cache_path,
+            storage=self.storage,
+            power_manager=power_manager,
+            cleaner=self.cleaner,
+            io_scheduler=remote,
+            **kwargs,
+        )
+
+    def start(self):
+        self.cleaner.start()
+        self.fs.start()
+
+    def stop(self):
+        self.fs.stop()
+        self.cleaner.stop()
+        shutil.rmtree(self.cache_path)
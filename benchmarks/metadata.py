@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+import json
+import os
+import platform
+import random
+import shutil
+import stat
+import sys
+import tempfile
+import time
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+
+from mucache.cleaner import Cleaner
+from mucache.file_builder import FileBuilder
+from mucache.filesystem import Filesystem
+from mucache.storage import SqliteWrapper, Storage
+from mucache.tree_index import TreeIndex
+from mucache.types import Entry, State
+
+from .fakes import GIB, FakePowerManager
+
+MIB = 1024 * 1024
+
+
+def create_arg_parser():
+    p = ArgumentParser(
+        description="Measure the metadata operations with synthetic libraries "
+        "of several sizes.",
+        prog="python -m benchmarks.metadata",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    p.add_argument('--entries', default=[10000, 100000, 1000000], type=int,
+                   nargs='+', help='number of entries of every library')
+    p.add_argument('--samples', default=10000, type=int,
+                   help='number of operations to measure every lookup')
+    p.add_argument('--deletes', default=20, type=int,
+                   help='number of series to delete')
+    p.add_argument('--cached-fraction', default=0.01, type=float,
+                   help='fraction of the files that are cached')
+    p.add_argument('--rebuild-max-entries', default=100000, type=int,
+                   help='maximum number of entries of the rebuilt tree, it '
+                   'has to be created in disk')
+    p.add_argument('--label', default='',
+                   help='label of the results, like the version')
+    p.add_argument('--output', default=None,
+                   help='file where append the results as a JSON line')
+    p.add_argument('--seed', default=0, type=int,
+                   help='seed of the libraries')
+    return p
+
+
+def generate_paths(n_entries, rnd):
+    # A library of series with seasons of episodes, and films with its
+    # subtitles in their own directories, yielding the directories with
+    # a trailing slash before its children
+    yield '/tv/'
+    yield '/films/'
+    n = 3
+    i = 0
+    while n < n_entries:
+        if rnd.random() < 0.8:
+            series = f"/tv/Series {i}"
+            yield f"{series}/"
+            n += 1
+            for season in range(1, rnd.randint(1, 8) + 1):
+                yield f"{series}/Season {season}/"
+                n += 1
+                for episode in range(1, rnd.randint(6, 24) + 1):
+                    yield f"{series}/Season {season}/S{season:02}E{episode:02}.mkv"
+                    n += 1
+        else:
+            film = f"/films/Film {i}"
+            yield f"{film}/"
+            yield f"{film}/Film {i}.mkv"
+            yield f"{film}/Film {i}.srt"
+            n += 3
+        i += 1
+
+
+def create_entries(n_entries, cached_fraction, rnd):
+    entries = [Entry(0, -1, '/', '', st_mode=stat.S_IFDIR | 0o755, st_size=0)]
+    ids_by_dir = {'/': 0}
+    for path in generate_paths(n_entries, rnd):
+        is_dir = path.endswith('/')
+        path = path.rstrip('/')
+        dir_path, name = path.rsplit('/', 1)
+        id = len(entries)
+        e = Entry(id, ids_by_dir[dir_path or '/'], path, name, st_ino=id,
+                  st_mtime=0)
+        if is_dir:
+            ids_by_dir[path] = id
+            e.st_mode = stat.S_IFDIR | 0o755
+            e.st_size = 0
+        else:
+            e.st_mode = stat.S_IFREG | 0o644
+            e.st_size = rnd.randint(100, 2000) * MIB
+            if not path.endswith('.srt'):
+                e.duration = rnd.randint(20, 120) * 60
+            if rnd.random() < cached_fraction:
+                e.state = State.CACHED
+                e.last_access_ts = rnd.randint(0, 1000000)
+        entries.append(e)
+    return entries
+
+
+def measure(name, samples, func):
+    times = []
+    start_ts = time.perf_counter()
+    for x in samples:
+        ts = time.perf_counter()
+        func(x)
+        times.append(time.perf_counter() - ts)
+    total_sec = time.perf_counter() - start_ts
+    times.sort()
+    return {
+        'name': name,
+        'ops': len(times),
+        'ops_per_sec': len(times) / total_sec if total_sec > 0 else 0,
+        'mean_us': total_sec * 1e6 / max(len(times), 1),
+        'p99_us': times[int(0.99 * (len(times) - 1))] * 1e6 if times else 0,
+    }
+
+
+def measure_once(name, n_items, func):
+    start_ts = time.perf_counter()
+    func()
+    total_sec = time.perf_counter() - start_ts
+    return {
+        'name': name,
+        'ops': n_items,
+        'ops_per_sec': n_items / total_sec if total_sec > 0 else 0,
+        'mean_us': total_sec * 1e6 / max(n_items, 1),
+        'total_sec': total_sec,
+    }
+
+
+def create_filesystem(storage, index=None):
+    # The lookups don't use the other components
+    return Filesystem(src_path='/', dst_path='/', storage=storage,
+                      power_manager=None, cleaner=None, prefetch_sec=3 * 60 * 60,
+                      prefetch_bytes=10 * GIB, index=index)
+
+
+def bench_lookups(storage, entries, args, rnd):
+    paths = [e.path for e in entries]
+    dirs = [e.path for e in entries if stat.S_ISDIR(e.st_mode)]
+    videos = [e.path for e in entries if e.duration is not None]
+    attr_samples = [rnd.choice(paths) for _ in range(args.samples)]
+    dir_samples = [rnd.choice(dirs) for _ in range(args.samples)]
+    video_samples = [rnd.choice(videos) for _ in range(args.samples)]
+
+    results = []
+    fs = create_filesystem(storage)
+    results.append(measure('getattr', attr_samples, fs.get_attr))
+    results.append(measure('readdir', dir_samples, fs.read_dir_attrs))
+    results.append(measure('next_files_to_cache', video_samples,
+                           lambda p: storage.get_next_files_to_cache(
+                               p, 3 * 60 * 60, 10 * GIB)))
+
+    index = TreeIndex()
+    results.append(measure_once('index_load', len(entries),
+                                lambda: index.load(storage)))
+    fs = create_filesystem(storage, index)
+    results.append(measure('index_getattr', attr_samples, fs.get_attr))
+    results.append(measure('index_readdir', dir_samples, fs.read_dir_attrs))
+    return results
+
+
+def bench_cleaner(storage, entries, cache_path):
+    # Sparse files so the cache doesn't need the real space
+    cached = [e for e in entries if e.state == State.CACHED]
+    for e in cached:
+        with open(os.path.join(cache_path, str(e.id)), 'wb') as f:
+            f.truncate(e.st_size)
+    cached_bytes = sum(e.st_size for e in cached)
+
+    # A cycle reconciles the DB with the cache directory and evicts the
+    # files over the limit, the loop does both before ending
+    cleaner = Cleaner(cache_path, storage, cached_bytes // 2)
+    return [measure_once('cleaner_cycle', len(cached),
+                         lambda: (cleaner.start(), cleaner.stop()))]
+
+
+def bench_deletes(storage, entries, args, rnd):
+    series = [e for e in entries if e.parent_id == 1]
+    to_delete = rnd.sample(series, min(args.deletes, len(series)))
+    builder = FileBuilder('/', storage, None, FakePowerManager())
+    n_deleted = sum(1 for e in entries if any(
+        e.path == s.path or e.path.startswith(s.path + '/') for s in to_delete))
+    return [measure_once('subtree_delete', n_deleted,
+                         lambda: [builder._del_id(e.id) for e in to_delete])]
+
+
+def bench_rebuild(tmp_path, n_entries, args, rnd):
+    src_path = os.path.join(tmp_path, 'src')
+    os.mkdir(src_path)
+    for path in generate_paths(n_entries, rnd):
+        full_path = os.path.join(src_path, path.strip('/'))
+        if path.endswith('/'):
+            os.mkdir(full_path)
+        else:
+            open(full_path, 'wb').close()
+
+    storage = Storage(SqliteWrapper(os.path.join(tmp_path, 'rebuild.sqlite')))
+    storage.setup()
+    builder = FileBuilder(src_path, storage, None, FakePowerManager())
+    n_indexed = sum(1 for _ in os.walk(src_path)) \
+        + sum(len(files) for _, _, files in os.walk(src_path))
+    return [measure_once('rebuild', n_indexed, builder.rebuild)]
+
+
+def bench(n_entries, args):
+    rnd = random.Random(args.seed)
+    tmp_path = tempfile.mkdtemp(prefix='mucache-metadata-')
+    try:
+        entries = create_entries(n_entries, args.cached_fraction, rnd)
+        storage = Storage(SqliteWrapper(os.path.join(tmp_path, 'db.sqlite')))
+        storage.setup()
+        results = [measure_once('insert', len(entries),
+                                lambda: storage.replace_entries(entries))]
+        results += bench_lookups(storage, entries, args, rnd)
+        cache_path = os.path.join(tmp_path, 'cache')
+        os.mkdir(cache_path)
+        results += bench_cleaner(storage, entries, cache_path)
+        results += bench_deletes(storage, entries, args, rnd)
+        if n_entries <= args.rebuild_max_entries:
+            results += bench_rebuild(tmp_path, n_entries, args, rnd)
+        return results
+    finally:
+        shutil.rmtree(tmp_path)
+
+
+def main():
+    args = create_arg_parser().parse_args()
+    run = {
+        'label': args.label,
+        'ts': int(time.time()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': {},
+    }
+
+    print(f"{'entries':>8} {'operation':<20} {'ops':>8} {'ops/sec':>12} "
+          f"{'mean us':>10} {'p99 us':>10}")
+    for n_entries in args.entries:
+        results = bench(n_entries, args)
+        run['results'][n_entries] = results
+        for r in results:
+            p99 = f"{r['p99_us']:>10.1f}" if 'p99_us' in r else f"{'-':>10}"
+            print(f"{n_entries:>8} {r['name']:<20} {r['ops']:>8} "
+                  f"{r['ops_per_sec']:>12.1f} {r['mean_us']:>10.1f} {p99}")
+
+    if args.output is not None:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(run) + '\n')
+    else:
+        json.dump(run, sys.stdout)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+import random
+import time
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from threading import Event, Lock, Thread
+
+from mucache.types import State
+
+from .fakes import MIB, FakePowerManager, FakeRemote, Library, Setup
+
+
+def create_arg_parser():
+    p = ArgumentParser(
+        description="Play files through the filesystem, without FUSE, "
+        "against a simulated remote.",
+        prog="python -m benchmarks.playback",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    p.add_argument('--scenarios', default=list(SCENARIOS), choices=SCENARIOS,
+                   nargs='+',
+                   help='scenarios to run')
+    p.add_argument('--latency-ms', default=20.0, type=float,
+                   help='latency of every remote read')
+    p.add_argument('--bandwidth-mib', default=40.0, type=float,
+                   help='bandwidth of the remote in mebibytes per second')
+    p.add_argument('--wake-ms', default=0, type=int,
+                   help='time to turn on the remote')
+    p.add_argument('--episode-mib', default=32, type=int,
+                   help='size of every episode')
+    p.add_argument('--episodes', default=4, type=int,
+                   help='number of episodes of every series')
+    p.add_argument('--bitrate-mbit', default=8.0, type=float,
+                   help='bitrate of the episodes in megabits per second')
+    p.add_argument('--speed', default=10.0, type=float,
+                   help='playback speed, relative to the bitrate')
+    p.add_argument('--read-kib', default=128, type=int,
+                   help='size of the reads of the player')
+    p.add_argument('--seeks', default=10, type=int,
+                   help='number of seeks of the seek scenario')
+    p.add_argument('--viewers', default=3, type=int,
+                   help='number of viewers of the concurrent scenario')
+    p.add_argument('--settle-sec', default=30, type=int,
+                   help='maximum time to wait for the played files to be '
+                   'cached after the playback')
+    p.add_argument('--prefetch-workers', default=1, type=int,
+                   help='number of files to prefetch at the same time')
+    p.add_argument('--read-ahead-chunks', default=32, type=int,
+                   help='maximum number of chunks to read ahead')
+    p.add_argument('--playback-lead-sec', default=60, type=int,
+                   help='seconds to keep cached ahead of the playback')
+    p.add_argument('--io-max-concurrent', default=4, type=int,
+                   help='maximum number of concurrent remote reads')
+    p.add_argument('--seed', default=0, type=int,
+                   help='seed of the seeks')
+    return p
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[int(round(p * (len(values) - 1)))]
+
+
+class Results:
+    def __init__(self):
+        self._lock = Lock()
+        self.open_ms = []
+        self.read_ms = []
+        self.opened_ts = {}
+
+    def add_open(self, path, ts, ms):
+        with self._lock:
+            self.open_ms.append(ms)
+            self.opened_ts.setdefault(path, ts)
+
+    def add_read(self, ms):
+        with self._lock:
+            self.read_ms.append(ms)
+
+
+class CachedWatcher:
+    # Poll the states to know when every file finished its caching
+    def __init__(self, storage, paths, every_sec=0.02):
+        self._storage = storage
+        self._paths = paths
+        self._every_sec = every_sec
+        self._stopped = Event()
+        self._thread = None
+        self.cached_ts = {}
+
+    def start(self):
+        self._thread = Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def _loop(self):
+        while not self._stopped.wait(self._every_sec):
+            for path in self._paths:
+                if path not in self.cached_ts \
+                        and self._storage.get_id_state_size(path)[1] == State.CACHED:
+                    self.cached_ts[path] = time.monotonic()
+
+    def wait(self, paths, timeout):
+        end_ts = time.monotonic() + timeout
+        while time.monotonic() < end_ts \
+                and not all(p in self.cached_ts for p in paths):
+            time.sleep(self._every_sec)
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+
+class Player:
+    def __init__(self, fs, results, bytes_per_sec, read_size):
+        self._fs = fs
+        self._results = results
+        self.bytes_per_sec = bytes_per_sec
+        self._read_size = read_size
+
+    def open(self, path):
+        start_ts = time.monotonic()
+        fh = self._fs.open(path)
+        end_ts = time.monotonic()
+        self._results.add_open(path, start_ts, (end_ts - start_ts) * 1000)
+        return fh
+
+    def play(self, path, fh, offset, n_bytes):
+        # Read at the playback rate, without waiting when it's behind
+        start_ts = time.monotonic()
+        end = offset + n_bytes
+        position = offset
+        while position < end:
+            length = min(self._read_size, end - position)
+            read_ts = time.monotonic()
+            data = self._fs.read(path, fh, length, position)
+            self._results.add_read((time.monotonic() - read_ts) * 1000)
+            if not data:
+                break
+            position += len(data)
+            delay = start_ts + (position - offset) / self.bytes_per_sec \
+                - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    def close(self, fh):
+        self._fs.close(fh)
+
+    def watch(self, path, size):
+        fh = self.open(path)
+        try:
+            self.play(path, fh, 0, size)
+        finally:
+            self.close(fh)
+
+
+def sequential(player, library, args, rnd):
+    path = library.paths[0]
+    player.watch(path, library.episode_bytes)
+    return [path]
+
+
+def seek(player, library, args, rnd):
+    path = library.paths[0]
+    play_bytes = int(2 * player.bytes_per_sec)
+    fh = player.open(path)
+    try:
+        player.play(path, fh, 0, play_bytes)
+        for _ in range(args.seeks):
+            offset = rnd.randrange(library.episode_bytes)
+            player.play(path, fh, offset, play_bytes)
+    finally:
+        player.close(fh)
+    return [path]
+
+
+def binge(player, library, args, rnd):
+    paths = library.paths[:args.episodes]
+    for path in paths:
+        player.watch(path, library.episode_bytes)
+    return paths
+
+
+def concurrent(player, library, args, rnd):
+    paths = [library.paths[v * args.episodes] for v in range(args.viewers)]
+    threads = [Thread(target=player.watch, args=(path, library.episode_bytes))
+               for path in paths]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return paths
+
+
+SCENARIOS = {
+    'sequential': sequential,
+    'seek': seek,
+    'binge': binge,
+    'concurrent': concurrent,
+}
+
+
+def run(name, library, args):
+    remote = FakeRemote(args.latency_ms / 1000, args.bandwidth_mib * MIB,
+                        max_concurrent=args.io_max_concurrent)
+    power_manager = FakePowerManager(wake_sec=args.wake_ms / 1000)
+    setup = Setup(
+        library, remote, power_manager,
+        prefetch_sec=args.episodes * library.duration,
+        prefetch_bytes=args.episodes * library.episode_bytes,
+        prefetch_workers=args.prefetch_workers,
+        read_ahead_chunks=args.read_ahead_chunks,
+        playback_lead_sec=args.playback_lead_sec,
+    )
+    results = Results()
+    player = Player(setup.fs, results, args.bitrate_mbit * 1e6 / 8 * args.speed,
+                    args.read_kib * 1024)
+    watcher = CachedWatcher(setup.storage, library.paths)
+
+    setup.start()
+    watcher.start()
+    start_ts = time.monotonic()
+    try:
+        played = SCENARIOS[name](player, library, args, random.Random(args.seed))
+        play_sec = time.monotonic() - start_ts
+        watcher.wait(played, args.settle_sec)
+    finally:
+        watcher.stop()
+        setup.stop()
+
+    cached_sec = [watcher.cached_ts[p] - results.opened_ts[p]
+                  for p in played if p in watcher.cached_ts]
+    if len(cached_sec) == len(played):
+        cached = f"{sum(cached_sec) / len(cached_sec):>10.2f}"
+    else:
+        cached = f"{'-':>10}"
+    print(f"{name:<12} {play_sec:>8.2f} "
+          f"{sum(results.open_ms) / max(len(results.open_ms), 1):>8.2f} "
+          f"{percentile(results.read_ms, 0.5):>8.2f} "
+          f"{percentile(results.read_ms, 0.99):>8.2f} {cached} "
+          f"{remote.fetched_bytes() / MIB:>10.1f} {power_manager.wake_ups:>6}")
+
+
+def main():
+    args = create_arg_parser().parse_args()
+    n_series = max(args.viewers, 1)
+    library = Library(n_series, args.episodes, args.episode_mib * MIB,
+                      args.bitrate_mbit * 1e6 / 8)
+    try:
+        print(f"{'scenario':<12} {'play sec':>8} {'open ms':>8} {'p50 ms':>8} "
+              f"{'p99 ms':>8} {'cached sec':>10} {'remote MiB':>10} {'wakes':>6}")
+        for name in args.scenarios:
+            run(name, library, args)
+    finally:
+        library.remove()
+
+
+if __name__ == '__main__':
+    main()
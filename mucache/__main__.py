@@ -1,4 +1,5 @@
 import logging
+import sys
 from argparse import (ArgumentDefaultsHelpFormatter, ArgumentParser,
                       ArgumentTypeError)
 
@@ -7,16 +8,29 @@ from power_manager.client import Client as PowerManagerClient
 from reinotify.proxy import Proxy as ReinotifyProxy
 from reinotify.server import Server as ReinotifyServer
 
+from .attr_cache import AttrCache, NegativeCache
+from .chunk_sizer import ChunkSizer
 from .cleaner import Cleaner
+from .duration_extractor import DurationExtractor
+from .eviction import POLICIES
 from .file_builder import FileBuilder
 from .filesystem import Filesystem
 from .fuse import FuseWrapper
-from .storage import SqliteWrapper, Storage
-from .types import State
+from .io_scheduler import IOScheduler
+from .metrics import MetricsServer, StatsFileWriter
+from .power_lease import PowerLease
+from .ram_cache import RamCache
+from .replay import main as replay_main
+from .segments import SegmentPinner, SegmentStore
+from .storage import SqlitePoolWrapper, SqliteWrapper, Storage
+from .trace import TraceRecorder
+from .tree_index import TreeIndex
+from .write_buffer import WriteBuffer
 
 logger = logging.getLogger(__name__)
 
 
+MIB = 1024 * 1024
 GIB = 1024 * 1024 * 1024
 
 
@@ -33,20 +47,104 @@ def create_arg_parser():
                    help='power manager address')
     p.add_argument('--pm-token-id', default='mucache',
                    help='the power manager token id')
+    p.add_argument('--pm-linger-sec', default=120, type=int,
+                   help='seconds to keep the power manager token after its '
+                   'last use')
+    p.add_argument('--pm-defer-sec', default=600, type=int,
+                   help='maximum seconds that the extraction of durations '
+                   'waits for the remote to be already on')
+    p.add_argument('--pin-segments-mib', default=0, type=int,
+                   help='MiB of the head and the tail of every media file '
+                   'kept in the cache to read them without turning on the '
+                   'remote, 0 to disable it')
+    p.add_argument('--pin-segments-limit-gib', default=8, type=int,
+                   help='maximum gibibytes of the pinned segments, they are '
+                   'counted in the cache limit')
     p.add_argument('--reinotify', default=Address('127.0.0.1', 4444),
                    type=type_address, help='reinotify listening host and port')
     p.add_argument('--reinotify-forward', default=None,
                    type=type_address, help='reinotify forward host and port')
     p.add_argument('--db-path', default='db.sqlite',
                    help='path of the sqlite database')
+    p.add_argument('--db-readers', default=0, type=int,
+                   help='number of pooled read-only connections to the '
+                   'sqlite database in WAL mode, 0 to use a single locked one')
+    p.add_argument('--db-flush-sec', default=5, type=float,
+                   help='seconds between the batched writes of the access '
+                   'timestamps and prefetch states, 0 to write them directly')
     p.add_argument('--cache-limit', default=180, type=int,
                    help='cache size limit in gibibytes')
+    p.add_argument('--cache-min-free-gib', default=0, type=int,
+                   help='minimum free space in gibibytes of the cache disk, '
+                   'the cache is evicted to keep it')
+    p.add_argument('--ram-cache-mib', default=0, type=int,
+                   help='mebibytes of memory to keep the most read chunks of '
+                   'the cached files, 0 to disable it')
+    p.add_argument('--eviction-policy', default='lru', choices=sorted(POLICIES),
+                   help='policy to choose the cached files to evict')
     p.add_argument('--prefetch-min', default=180, type=int,
                    help='maximum number of minutes to prefetch')
     p.add_argument('--prefetch-gib', default=10, type=int,
                    help='maximum number of gibibytes to prefetch')
+    p.add_argument('--prefetch-workers', default=1, type=int,
+                   help='number of files to prefetch at the same time')
+    p.add_argument('--read-ahead-chunks', default=32, type=int,
+                   help='maximum number of chunks to read ahead when a '
+                   'caching file is read sequentially, 0 to disable it')
+    p.add_argument('--passthrough-mib', default=None, type=int,
+                   help='mebibytes read from a file before caching it, by '
+                   'default 15%% of its size between 16 and 64 MiB')
+    p.add_argument('--playback-lead-sec', default=60, type=int,
+                   help='seconds of a file being played to keep cached ahead '
+                   'of the playback before prefetching other files, 0 to '
+                   'cache it linearly')
+    p.add_argument('--io-max-concurrent', default=4, type=int,
+                   help='maximum number of concurrent reads of the source '
+                   'files, the playback reads go before the prefetch ones')
+    p.add_argument('--prefetch-mib-per-sec', default=0, type=float,
+                   help='maximum bandwidth used to prefetch files, 0 for '
+                   'no limit')
+    p.add_argument('--chunk-min-kib', default=64, type=type_power_of_two,
+                   help='minimum size of the cached chunks in kibibytes')
+    p.add_argument('--chunk-max-kib', default=4096, type=type_power_of_two,
+                   help='maximum size of the cached chunks in kibibytes')
+    p.add_argument('--chunk-target-ms', default=100, type=int,
+                   help='the chunk size of every file is chosen to take '
+                   'this time to be copied with the measured throughput')
+    p.add_argument('--memory-index', action='store_true',
+                   help='serve the attributes and directory listings from '
+                   'an in-memory copy of the DB tree')
+    p.add_argument('--attr-cache-sec', default=1.0, type=float,
+                   help='seconds to keep the attributes of the entries listed '
+                   'in a dir for the next getattr calls, 0 to disable it')
+    p.add_argument('--negative-cache-size', default=10000, type=int,
+                   help='maximum number of missing paths to remember, 0 to '
+                   'disable it')
+    p.add_argument('--entry-timeout', default=30.0, type=float,
+                   help='seconds that the kernel caches the names lookups')
+    p.add_argument('--attr-timeout', default=30.0, type=float,
+                   help='seconds that the kernel caches the attributes')
+    p.add_argument('--negative-timeout', default=10.0, type=float,
+                   help='seconds that the kernel caches the missing names')
     p.add_argument('--rebuild', action='store_true',
                    help='purge the DB and index the files')
+    p.add_argument('--resync', action='store_true',
+                   help='index only the files added, modified or removed '
+                   'since the last indexing')
+    p.add_argument('--index-workers', default=8, type=int,
+                   help='number of threads scanning the directories when indexing')
+    p.add_argument('--exiftool-workers', default=4, type=int,
+                   help='number of exiftool processes extracting the durations when indexing')
+    p.add_argument('--metrics-address', default=None, type=type_address,
+                   help='address where expose the metrics in the Prometheus '
+                   'text format, in the format <host>:<port>')
+    p.add_argument('--stats-file', default=None,
+                   help='file where write periodically the metrics')
+    p.add_argument('--stats-every-sec', default=15, type=int,
+                   help='seconds between the writes of the stats file')
+    p.add_argument('--trace-file', default=None,
+                   help='file where record the opens, reads and releases to '
+                   'replay them with "python -m mucache replay"')
     p.add_argument('--log-level', default='INFO',
                    choices=('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'),
                    help='logger level')
@@ -64,6 +162,16 @@ def type_address(x):
         raise ArgumentTypeError("The port must be a valid number")
 
 
+def type_power_of_two(x):
+    try:
+        v = int(x)
+    except ValueError:
+        raise ArgumentTypeError("The value must be a valid number")
+    if v <= 0 or (v & (v - 1)) != 0:
+        raise ArgumentTypeError("The value must be a power of two")
+    return v
+
+
 class Address(tuple):
     def __new__(self, host, port):
         return tuple.__new__(Address, (host, port))
@@ -73,20 +181,29 @@ class Address(tuple):
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'replay':
+        replay_main(sys.argv[2:])
+        return
+
     parser = create_arg_parser()
     args = parser.parse_args()
 
     logging.basicConfig(level=args.log_level)
 
     logger.debug("Starting DB")
-    db = SqliteWrapper(args.db_path)
+    if args.db_readers > 0:
+        db = SqlitePoolWrapper(args.db_path, max_readers=args.db_readers)
+    else:
+        db = SqliteWrapper(args.db_path)
 
     logger.debug("Starting storage")
     storage = Storage(db)
     storage.setup()
 
     logger.debug("Starting power manager")
-    pm = PowerManagerClient(args.pm_address, token_id=args.pm_token_id)
+    pm_client = PowerManagerClient(args.pm_address, token_id=args.pm_token_id)
+    pm_client.start()
+    pm = PowerLease(pm_client, linger_sec=args.pm_linger_sec)
     pm.start()
 
     if args.reinotify_forward is not None:
@@ -95,36 +212,150 @@ def main():
     else:
         reinotify_proxy = None
 
+    duration_extractor = DurationExtractor(args.src_path, storage, pm,
+                                           awake_wait_sec=args.pm_defer_sec)
+
+    io_scheduler = IOScheduler(
+        max_concurrent=args.io_max_concurrent,
+        prefetch_bytes_per_sec=args.prefetch_mib_per_sec * MIB,
+    )
+
+    if args.pin_segments_mib > 0:
+        segment_store = SegmentStore(args.cache_path,
+                                     args.pin_segments_mib * MIB,
+                                     args.pin_segments_mib * MIB,
+                                     args.pin_segments_limit_gib * GIB)
+        segment_pinner = SegmentPinner(args.src_path, segment_store, storage,
+                                       pm, io_scheduler=io_scheduler)
+    else:
+        segment_store = None
+        segment_pinner = None
+
     logger.debug("Starting file builder")
-    file_builder = FileBuilder(args.src_path, storage, reinotify_proxy, pm)
+    index = TreeIndex() if args.memory_index else None
+    attr_cache = AttrCache(args.attr_cache_sec) if args.attr_cache_sec > 0 else None
+    if args.negative_cache_size > 0:
+        negative_cache = NegativeCache(max_entries=args.negative_cache_size)
+    else:
+        negative_cache = None
+    file_builder = FileBuilder(args.src_path, storage, reinotify_proxy, pm,
+                               index=index,
+                               scan_workers=args.index_workers,
+                               exif_workers=args.exiftool_workers,
+                               duration_extractor=duration_extractor,
+                               attr_cache=attr_cache,
+                               negative_cache=negative_cache,
+                               segment_pinner=segment_pinner,
+                               cache_path=args.cache_path)
 
     if args.rebuild:
         file_builder.rebuild()
     else:
-        storage.set_states(State.CACHING, State.NO_CACHED)
+        if args.resync:
+            file_builder.resync()
+        if index is not None:
+            logger.debug("Loading the tree index")
+            index.load(storage)
+
+    logger.debug("Starting duration extractor")
+    duration_extractor.start()
+
+    if segment_pinner is not None:
+        logger.debug("Starting segment pinner")
+        segment_pinner.start()
 
     logger.debug("Starting remote watcher server")
     reinotify_server = ReinotifyServer(args.reinotify, file_builder.inotify)
     reinotify_server.start()
 
+    if args.db_flush_sec > 0:
+        logger.debug("Starting write buffer")
+        write_buffer = WriteBuffer(storage, flush_every_sec=args.db_flush_sec)
+        write_buffer.start()
+    else:
+        write_buffer = None
+
+    ram_cache = RamCache(args.ram_cache_mib * MIB) if args.ram_cache_mib > 0 else None
+
     logger.debug("Starting cleaner")
-    cleaner = Cleaner(args.cache_path, storage, args.cache_limit * GIB)
+    cleaner = Cleaner(args.cache_path, storage, args.cache_limit * GIB,
+                      write_buffer=write_buffer,
+                      min_free_bytes=args.cache_min_free_gib * GIB,
+                      eviction_policy=args.eviction_policy,
+                      ram_cache=ram_cache,
+                      segment_store=segment_store)
     cleaner.start()
 
+    chunk_sizer = ChunkSizer(
+        min_bits=args.chunk_min_kib.bit_length() - 1 + 10,
+        max_bits=args.chunk_max_kib.bit_length() - 1 + 10,
+        target_sec=args.chunk_target_ms / 1000,
+    )
+
+    if args.passthrough_mib is not None:
+        passthrough_bytes = args.passthrough_mib * MIB
+    else:
+        passthrough_bytes = None
+
     logger.debug("Starting file manager")
     fs = Filesystem(src_path=args.src_path, dst_path=args.cache_path,
                     storage=storage, power_manager=pm, cleaner=cleaner,
                     prefetch_sec=args.prefetch_min * 60,
-                    prefetch_bytes=args.prefetch_gib * GIB)
+                    prefetch_bytes=args.prefetch_gib * GIB,
+                    prefetch_workers=args.prefetch_workers,
+                    read_ahead_chunks=args.read_ahead_chunks,
+                    chunk_sizer=chunk_sizer,
+                    io_scheduler=io_scheduler,
+                    playback_lead_sec=args.playback_lead_sec,
+                    passthrough_bytes=passthrough_bytes,
+                    attr_cache=attr_cache,
+                    negative_cache=negative_cache,
+                    segment_store=segment_store,
+                    ram_cache=ram_cache,
+                    index=index,
+                    write_buffer=write_buffer)
+    fs.resume_caching()
     fs.start()
 
+    if args.metrics_address is not None:
+        logger.debug("Starting metrics server")
+        metrics_server = MetricsServer(args.metrics_address)
+        metrics_server.start()
+    else:
+        metrics_server = None
+    if args.stats_file is not None:
+        stats_writer = StatsFileWriter(args.stats_file, args.stats_every_sec)
+        stats_writer.start()
+    else:
+        stats_writer = None
+
+    if args.trace_file is not None:
+        trace_recorder = TraceRecorder(args.trace_file)
+    else:
+        trace_recorder = None
+
     try:
         logger.info("Starting FUSE")
-        FUSE(FuseWrapper(fs), args.fuse_path, nothreads=False,
-             foreground=True, allow_other=True, ro=True)
+        FUSE(FuseWrapper(fs, trace_recorder), args.fuse_path, nothreads=False,
+             foreground=True, allow_other=True, ro=True,
+             entry_timeout=args.entry_timeout,
+             attr_timeout=args.attr_timeout,
+             negative_timeout=args.negative_timeout)
     finally:
+        if metrics_server is not None:
+            metrics_server.stop()
         fs.stop()
         cleaner.stop()
+        duration_extractor.stop()
+        if segment_pinner is not None:
+            segment_pinner.stop()
+        if write_buffer is not None:
+            write_buffer.stop()
+        if stats_writer is not None:
+            stats_writer.stop()
+        if trace_recorder is not None:
+            trace_recorder.close()
+        pm.stop()
 
 
 if __name__ == '__main__':
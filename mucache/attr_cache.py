@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class AttrCache:
+    # Keep for a short time the attributes of the entries listed by readdir,
+    # so the getattr calls that follow it don't go to the DB
+    def __init__(self, ttl_sec=1.0, max_entries=100000):
+        self._ttl_sec = ttl_sec
+        self._max_entries = max_entries
+        self._lock = Lock()
+        self._entries = {}
+
+    def get(self, path):
+        item = self._entries.get(path)
+        if item is None:
+            return None
+        expiration_ts, attrs = item
+        if expiration_ts < time.monotonic():
+            return None
+        return attrs
+
+    def put_many(self, items):
+        now = time.monotonic()
+        expiration_ts = now + self._ttl_sec
+        with self._lock:
+            if len(self._entries) >= self._max_entries:
+                self._purge(now)
+            for path, attrs in items:
+                self._entries[path] = (expiration_ts, attrs)
+
+    def _purge(self, now):
+        self._entries = {k: v for k, v in self._entries.items() if v[0] >= now}
+        if len(self._entries) >= self._max_entries:
+            self._entries = {}
+
+    def invalidate(self, path):
+        with self._lock:
+            self._entries.pop(path, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+
+class NegativeCache:
+    # Remember the paths that don't exist, like the subtitles and covers that
+    # the players look for next to every video. They are removed when the
+    # paths are created and expire anyway in case an event is lost.
+    def __init__(self, ttl_sec=300, max_entries=10000):
+        self._ttl_sec = ttl_sec
+        self._max_entries = max_entries
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        # Incremented with every invalidation, so a lookup that started
+        # before the path was created doesn't add it
+        self._generation = 0
+
+    def generation(self):
+        return self._generation
+
+    def contains(self, path):
+        expiration_ts = self._entries.get(path)
+        return expiration_ts is not None and expiration_ts >= time.monotonic()
+
+    def add(self, path, generation):
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[path] = time.monotonic() + self._ttl_sec
+            self._entries.move_to_end(path)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    # Remove the path and the ones under it
+    def invalidate(self, path):
+        prefix = path.rstrip('/') + '/'
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(path, None)
+            for p in [p for p in self._entries if p.startswith(prefix)]:
+                del self._entries[p]
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
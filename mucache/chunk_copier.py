@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+import errno
+import fcntl
+import logging
+import os
+from threading import local
+
+logger = logging.getLogger(__name__)
+
+# Errors returned when a method isn't supported between the two files
+UNSUPPORTED_ERRNOS = frozenset((
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+    errno.ENOTSUP,
+))
+# Errors returned when the kernel doesn't implement a method for any file
+DISABLING_ERRNOS = frozenset((errno.ENOSYS,))
+
+PIPE_SIZE = 1024 * 1024
+
+
+class Pipe:
+    # Closed with the thread that owns it
+    def __init__(self):
+        self.r, self.w = os.pipe()
+        try:
+            fcntl.fcntl(self.w, fcntl.F_SETPIPE_SZ, PIPE_SIZE)
+        except OSError:
+            pass
+        self.size = fcntl.fcntl(self.w, fcntl.F_GETPIPE_SZ)
+
+    def close(self):
+        if self.r is not None:
+            os.close(self.r)
+            os.close(self.w)
+            self.r = self.w = None
+
+    def __del__(self):
+        self.close()
+
+
+class ChunkCopier:
+    def __init__(self, methods=None):
+        if methods is None:
+            methods = self.available_methods()
+        self._methods = [getattr(self, f"_copy_with_{m}") for m in methods]
+        self._local = local()
+
+    @staticmethod
+    def available_methods():
+        methods = []
+        if hasattr(os, 'copy_file_range'):
+            methods.append('copy_file_range')
+        if hasattr(os, 'splice'):
+            methods.append('splice')
+        methods.append('buffer')
+        return methods
+
+    def copy(self, src_fd, dst_fd, offset, size):
+        # A method unsupported between these two files is only skipped in
+        # this copy, other mounts can support it
+        methods = self._methods
+        end = offset + size
+        while offset < end:
+            method = methods[0]
+            try:
+                n = method(src_fd, dst_fd, offset, end - offset)
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS or len(methods) == 1:
+                    raise
+                methods = methods[1:]
+                if e.errno in DISABLING_ERRNOS:
+                    logger.info(f"Disabling the copy method '{method.__name__}': {e}")
+                    self._methods = [m for m in self._methods if m != method]
+                continue
+            if n == 0:
+                break
+            offset += n
+        return size - (end - offset)
+
+    def _copy_with_copy_file_range(self, src_fd, dst_fd, offset, size):
+        return os.copy_file_range(src_fd, dst_fd, size, offset, offset)
+
+    # Through a pipe, because sendfile writes at the offset of the
+    # destination shared by the threads copying chunks of the same file
+    def _copy_with_splice(self, src_fd, dst_fd, offset, size):
+        pipe = getattr(self._local, 'pipe', None)
+        if pipe is None:
+            pipe = self._local.pipe = Pipe()
+        n = os.splice(src_fd, pipe.w, min(size, pipe.size), offset_src=offset)
+        written = 0
+        try:
+            while written < n:
+                written += os.splice(pipe.r, dst_fd, n - written,
+                                     offset_dst=offset + written)
+        except:
+            # The pipe keeps the data that wasn't written
+            pipe.close()
+            self._local.pipe = None
+            raise
+        return n
+
+    def _copy_with_buffer(self, src_fd, dst_fd, offset, size):
+        buf = getattr(self._local, 'buf', None)
+        if buf is None or len(buf) < size:
+            buf = self._local.buf = memoryview(bytearray(size))
+        n = os.preadv(src_fd, [buf[:size]], offset)
+        written = 0
+        while written < n:
+            written += os.pwrite(dst_fd, buf[written:n], offset + written)
+        return n
+
+
+DEFAULT_COPIER = ChunkCopier()
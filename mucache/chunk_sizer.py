@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+from threading import Lock
+
+KIB = 1024
+
+
+class ChunkSizer:
+    # Choose the chunk size of every file in a way that copying a chunk
+    # takes around `target_sec` with the throughput measured of the remote
+    # reads. As the throughput is measured with the same chunks it converges
+    # to `bandwidth * (target_sec - latency)`, so the bigger the latency or
+    # the bandwidth the bigger the chunks.
+    def __init__(self, min_bits=16, max_bits=22, default_bits=18,
+                 target_sec=0.1, min_chunks_per_file=16, alpha=0.2):
+        self._min_bits = min_bits
+        self._max_bits = max(min_bits, max_bits)
+        self._default_bits = default_bits
+        self._target_sec = target_sec
+        self._min_chunks_per_file = min_chunks_per_file
+        self._alpha = alpha
+        self._lock = Lock()
+        self._throughput = None
+
+    def throughput(self):
+        return self._throughput
+
+    def record(self, n_bytes, elapsed_sec):
+        if n_bytes <= 0 or elapsed_sec <= 0:
+            return
+        sample = n_bytes / elapsed_sec
+        with self._lock:
+            if self._throughput is None:
+                self._throughput = sample
+            else:
+                self._throughput += self._alpha * (sample - self._throughput)
+
+    def get_bits(self, size):
+        throughput = self._throughput
+        if throughput is None:
+            bits = self._default_bits
+        else:
+            bits = _log2(throughput * self._target_sec)
+        bits = min(bits, _log2(size // self._min_chunks_per_file))
+        return max(self._min_bits, min(bits, self._max_bits))
+
+
+def _log2(x):
+    return max(int(x).bit_length() - 1, 0)
@@ -2,95 +2,233 @@
 import logging
 import os
 import os.path
-from queue import Queue
+from queue import Empty, Queue
 from threading import Thread
 
+from .eviction import create_policy
+from .file_chunks import BITMAP_SUFFIX
+from .metrics import REGISTRY
 from .types import State
 
 logger = logging.getLogger(__name__)
 
+EVICTIONS = REGISTRY.counter(
+    'mucache_evictions_total', "Number of cached files evicted")
+EVICTED_BYTES = REGISTRY.counter(
+    'mucache_evicted_bytes_total', "Bytes of the cached files evicted")
+CACHED_BYTES = REGISTRY.gauge(
+    'mucache_cached_bytes', "Bytes of the cached files")
+RESERVED_BYTES = REGISTRY.gauge(
+    'mucache_reserved_bytes', "Bytes reserved for the files being cached")
+
 
 class Cleaner:
-    def __init__(self, path, storage, limit_in_bytes, retention_factor=0.6, expire_in_sec=60*60*8):
+    def __init__(self, path, storage, limit_in_bytes, retention_factor=0.6, expire_in_sec=60*60*8,
+                 write_buffer=None, min_free_bytes=0, check_every_sec=60,
+                 eviction_policy='lru', ram_cache=None, segment_store=None):
         self._path = path
         self._storage = storage
+        self._write_buffer = write_buffer
         self._limit_in_bytes = limit_in_bytes
         self._retention_factor = retention_factor
         self._expire_in_sec = expire_in_sec
+        self._min_free_bytes = min_free_bytes
+        self._check_every_sec = check_every_sec
+        self._eviction_policy = eviction_policy
+        self._ram_cache = ram_cache
+        # The pinned segments aren't evicted, but use the same space
+        self._segment_store = segment_store
+
+        # The sizes of the cached files by id, the policy choose the order
+        # in which they are evicted
+        self._cached = {}
+        self._policy = create_policy(eviction_policy, limit_in_bytes)
+        self._cached_bytes = 0
+        self._reserved_bytes = 0
 
         self._thread = None
         self._loop_queue = Queue()
 
     def to_add(self, n_bytes):
-        self._loop_queue.put(n_bytes)
+        self._loop_queue.put(('add', n_bytes))
+
+    def cancel_add(self, n_bytes):
+        self._loop_queue.put(('cancel_add', n_bytes))
+
+    def on_cached(self, id, n_bytes, ts):
+        self._loop_queue.put(('cached', id, n_bytes, ts))
+
+    def on_access(self, id, ts):
+        self._loop_queue.put(('access', id, ts))
 
     def start(self):
         self._thread = Thread(target=self._loop)
         self._thread.start()
 
     def _loop(self):
-        limit_in_bytes = self._limit_in_bytes * self._retention_factor
-        used_bytes = self._cleanup(limit_in_bytes)
+        self._reconcile()
+        self._cleanup()
+        self._update_metrics()
 
         while True:
-            n_bytes = self._loop_queue.get()
-            if n_bytes is None:
-                break
-            used_bytes += n_bytes
-            if used_bytes > self._limit_in_bytes:
-                used_bytes = self._cleanup(limit_in_bytes)
-
-    def _cleanup(self, limit_in_bytes):
-        self._uncache_removed_cache_files()
-        used_bytes = self._uncache_old_files(limit_in_bytes)
-        self._remove_uncached_cache_files()
+            try:
+                msg = self._loop_queue.get(timeout=self._check_every_sec)
+            except Empty:
+                self._cleanup()
+                self._update_metrics()
+                continue
+            try:
+                if msg is None:
+                    break
+                self._handle(*msg)
+                if msg[0] != 'access':
+                    self._cleanup()
+                    self._update_metrics()
+            finally:
+                self._loop_queue.task_done()
+
+    def _update_metrics(self):
+        CACHED_BYTES.set(self._cached_bytes)
+        RESERVED_BYTES.set(self._reserved_bytes)
+
+    def _handle(self, action, *args):
+        if action == 'add':
+            self._reserved_bytes += args[0]
+        elif action == 'cancel_add':
+            self._reserved_bytes = max(self._reserved_bytes - args[0], 0)
+        elif action == 'cached':
+            id, n_bytes, ts = args
+            self._reserved_bytes = max(self._reserved_bytes - n_bytes, 0)
+            self._set_cached(id, n_bytes, ts, self._storage.get_access_count(id))
+        elif action == 'access':
+            id, ts = args
+            if id in self._cached:
+                self._policy.access(id, ts)
+
+    def _set_cached(self, id, n_bytes, ts, count):
+        self._cached_bytes += n_bytes - self._cached.get(id, 0)
+        self._cached[id] = n_bytes
+        self._policy.add(id, n_bytes, ts, count)
+
+    def _used_bytes(self):
+        used_bytes = self._cached_bytes + self._reserved_bytes
+        if self._segment_store is not None:
+            used_bytes += self._segment_store.bytes()
         return used_bytes
 
-    def _uncache_removed_cache_files(self):
-        for id in self._storage.get_cached_ids():
+    def _free_bytes(self):
+        if self._min_free_bytes <= 0:
+            return None
+        st = os.statvfs(self._path)
+        return st.f_bavail * st.f_frsize
+
+    def _cleanup(self):
+        # Evict when the used bytes or the free space cross the high
+        # watermarks and until both are back under the low ones
+        free_bytes = self._free_bytes()
+        if self._used_bytes() <= self._limit_in_bytes \
+                and (free_bytes is None or free_bytes >= self._min_free_bytes):
+            return
+
+        limit_in_bytes = self._limit_in_bytes * self._retention_factor
+        min_free_bytes = self._min_free_bytes / self._retention_factor
+        while self._used_bytes() > limit_in_bytes \
+                or (free_bytes is not None and free_bytes < min_free_bytes):
+            id = self._policy.pop()
+            if id is None:
+                break
+            n_bytes = self._uncache(id)
+            EVICTIONS.inc()
+            EVICTED_BYTES.inc(n_bytes)
+            if free_bytes is not None:
+                free_bytes += n_bytes
+
+    def _uncache(self, id):
+        logger.debug(f"Unmarking the old cache file with id {id}")
+        self._storage.set_state(id, State.CACHED, State.NO_CACHED)
+        n_bytes = self._cached.pop(id)
+        self._cached_bytes -= n_bytes
+        if self._ram_cache is not None:
+            self._ram_cache.invalidate(id)
+        path = os.path.join(self._path, str(id))
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except:
+            logger.exception(f"Error removing the cached file {id}")
+        return n_bytes
+
+    def _reconcile(self):
+        logger.debug("Reconciling the cache directory with the DB")
+        # The eviction order needs the accesses of the files up to date
+        if self._write_buffer is not None:
+            self._write_buffer.flush()
+        entries = {id: (state, ts, count, size)
+                   for id, state, ts, count, size in self._storage.get_cache_entries()}
+        self._uncache_removed_cache_files(entries)
+        self._remove_uncached_cache_files(entries)
+
+        self._cached = {}
+        self._cached_bytes = 0
+        self._reserved_bytes = 0
+        self._policy = create_policy(self._eviction_policy, self._limit_in_bytes)
+        cached = sorted((ts or 0, id, count, size)
+                        for id, (state, ts, count, size) in entries.items()
+                        if state == State.CACHED)
+        for ts, id, count, size in cached:
+            self._set_cached(id, size, ts, count)
+
+    def _uncache_removed_cache_files(self, entries):
+        for id, (state, _, _, size) in list(entries.items()):
+            if state != State.CACHED:
+                continue
             path = os.path.join(self._path, str(id))
             if not os.path.exists(path):
                 logger.warning(f"Unmarking the removed cache file with id {id}")
                 self._storage.set_state(id, State.CACHED, State.NO_CACHED)
+                if self._ram_cache is not None:
+                    self._ram_cache.invalidate(id)
+                del entries[id]
 
-    def _uncache_old_files(self, limit_in_bytes):
-        used_bytes = self._storage.get_cached_bytes()
-        while used_bytes > limit_in_bytes:
-            has_more, rows = self._storage.get_oldest_cached_files()
-            for id, n_bytes in rows:
-                logger.debug(f"Unmarking the old cache file with id {id}")
-                self._storage.set_state(id, State.CACHED, State.NO_CACHED)
-                used_bytes -= n_bytes
-                if used_bytes <= limit_in_bytes:
-                    break
-            if not has_more:
-                break
-        return used_bytes
-
-    def _remove_uncached_cache_files(self):
+    def _remove_uncached_cache_files(self, entries):
         with os.scandir(self._path) as it:
             for entry in it:
-                if entry.is_file() and not self._is_valid_cache_file(entry):
+                if entry.is_file() and not self._is_valid_cache_file(entry, entries):
                     logger.debug(f"Removing the cache file '{entry.path}'")
                     try:
                         os.remove(entry.path)
                     except:
                         logger.exception(f"Error removing the cached file {id}")
 
-    def _is_valid_cache_file(self, entry):
+    def _is_valid_cache_file(self, entry, entries):
+        name = entry.name
+        # The bitmap being saved of a file in caching
+        is_tmp_bitmap = name.endswith(f"{BITMAP_SUFFIX}.tmp")
+        if is_tmp_bitmap:
+            name = name[:-len('.tmp')]
+        is_bitmap = name.endswith(BITMAP_SUFFIX)
+        if is_bitmap:
+            name = name[:-len(BITMAP_SUFFIX)]
         try:
-            id = int(entry.name)
+            id = int(name)
         except ValueError:
-            logger.warning("The cache file '{entry.name}' isn't a number")
+            logger.warning(f"The cache file '{entry.name}' isn't a number")
             return False
-        state, size = self._storage.get_state_size(id)
+        state, _, _, size = entries.get(id, (None, None, None, None))
         if state in (None, State.NO_CACHED):
             return False
+        if is_bitmap:
+            return state == State.CACHING
         if state == State.CACHED and size != entry.stat().st_size:
             self._storage.set_state(id, State.CACHED, State.NO_CACHED)
+            del entries[id]
             return False
         return True
 
+    def wait_idle(self):
+        self._loop_queue.join()
+
     def stop(self):
         self._loop_queue.put(None)
         self._thread.join()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+import logging
+import os.path
+import time
+from queue import Empty, Queue
+from threading import Event, Thread
+
+from exiftool import ExifTool
+
+logger = logging.getLogger(__name__)
+
+
+def parse_durations(data):
+    # Map the output of `ExifTool.get_tags_batch` by path
+    durations = {}
+    for d in data:
+        source_file = d.pop('SourceFile', None)
+        durations[source_file] = next(
+            (v for k, v in d.items() if k.split(':')[-1] == 'Duration'),
+            None
+        )
+    return durations
+
+
+class DurationExtractor:
+    # Extract in background the durations of the files already published
+    # in the DB, grouping the files added close in time in a single batch
+    # with the power manager token held. With a power lease, the batches can
+    # wait some time for the remote to be on by other reasons.
+    def __init__(self, src_path, storage, power_manager, batch_size=64,
+                 batch_wait_sec=2, awake_wait_sec=0):
+        self._src_path = src_path
+        self._storage = storage
+        self._power_manager = power_manager
+        self._batch_size = batch_size
+        self._batch_wait_sec = batch_wait_sec
+        self._awake_wait_sec = awake_wait_sec
+
+        self._thread = None
+        self._loop_queue = Queue()
+        self._stopped = Event()
+
+    def add(self, id, relpath):
+        self._loop_queue.put((id, relpath))
+
+    def start(self):
+        for id, relpath in self._storage.get_pending_durations():
+            self.add(id, relpath)
+        self._thread = Thread(target=self._loop)
+        self._thread.start()
+
+    def _loop(self):
+        with ExifTool() as exif_tool:
+            stopped = False
+            while not stopped:
+                item = self._loop_queue.get()
+                if item is None:
+                    break
+                # The pending files are queued again in the next start
+                if self._awake_wait_sec > 0 and not self._wait_awake():
+                    break
+                batch = [item]
+                deadline = time.monotonic() + self._batch_wait_sec
+                while len(batch) < self._batch_size:
+                    timeout = deadline - time.monotonic()
+                    try:
+                        item = self._loop_queue.get(timeout=max(timeout, 0))
+                    except Empty:
+                        break
+                    if item is None:
+                        stopped = True
+                        break
+                    batch.append(item)
+                try:
+                    self._extract(exif_tool, batch)
+                except:
+                    logger.exception(f"Error extracting the duration of {len(batch)} files")
+
+    # Return if it wasn't stopped while waiting
+    def _wait_awake(self):
+        deadline = time.monotonic() + self._awake_wait_sec
+        while not self._stopped.is_set():
+            timeout = deadline - time.monotonic()
+            if timeout <= 0 or self._power_manager.wait_awake(min(timeout, 1)):
+                return True
+        return False
+
+    def _extract(self, exif_tool, batch):
+        paths = [os.path.join(self._src_path, relpath[1:]) for _, relpath in batch]
+        logger.debug(f"Extracting the duration of {len(paths)} files")
+        try:
+            self._power_manager.acquire()
+            data = exif_tool.get_tags_batch(['Duration'], paths)
+        finally:
+            self._power_manager.release()
+
+        durations = parse_durations(data)
+        self._storage.set_durations(
+            (id, durations.get(path)) for (id, _), path in zip(batch, paths)
+        )
+
+    def stop(self):
+        self._stopped.set()
+        self._loop_queue.put(None)
+        self._thread.join()
+        self._thread = None
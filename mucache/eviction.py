@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+import heapq
+from collections import OrderedDict
+
+
+class EvictionPolicy:
+    def add(self, id, size, ts, count):
+        raise NotImplementedError
+
+    def access(self, id, ts):
+        raise NotImplementedError
+
+    def remove(self, id):
+        raise NotImplementedError
+
+    def pop(self):
+        raise NotImplementedError
+
+
+class HeapPolicy(EvictionPolicy):
+    # Evict the file with the lowest priority, the heap entries whose
+    # priority doesn't match the current one are outdated and ignored
+    def __init__(self):
+        self._entries = {}
+        self._heap = []
+
+    def _priority(self, size, ts, count):
+        raise NotImplementedError
+
+    def add(self, id, size, ts, count):
+        self._set(id, size, ts, count)
+
+    def access(self, id, ts):
+        entry = self._entries.get(id)
+        if entry is not None:
+            _, size, _, count = entry
+            self._set(id, size, ts, count + 1)
+
+    def _set(self, id, size, ts, count):
+        priority = self._priority(size, ts, count)
+        self._entries[id] = (priority, size, ts, count)
+        heapq.heappush(self._heap, (priority, id))
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [(e[0], id) for id, e in self._entries.items()]
+            heapq.heapify(self._heap)
+
+    def remove(self, id):
+        self._entries.pop(id, None)
+
+    def pop(self):
+        while self._heap:
+            priority, id = heapq.heappop(self._heap)
+            entry = self._entries.get(id)
+            if entry is not None and entry[0] == priority:
+                del self._entries[id]
+                self._on_evict(priority)
+                return id
+        return None
+
+    def _on_evict(self, priority):
+        pass
+
+
+class LRUPolicy(HeapPolicy):
+    def _priority(self, size, ts, count):
+        return ts
+
+
+class LFUPolicy(HeapPolicy):
+    # LFU with dynamic aging, the priority of the evicted files is added to
+    # the new ones so the files that were popular long ago end up evicted
+    def __init__(self):
+        super().__init__()
+        self._age = 0
+
+    def _priority(self, size, ts, count):
+        return (self._age + count, ts)
+
+    def _on_evict(self, priority):
+        self._age = priority[0]
+
+
+class GDSFPolicy(HeapPolicy):
+    # Greedy-Dual-Size-Frequency, like the LFU with aging but dividing the
+    # frequency by the size to keep more files for the same space
+    def __init__(self):
+        super().__init__()
+        self._age = 0.0
+
+    def _priority(self, size, ts, count):
+        return (self._age + max(count, 1) / max(size, 1), ts)
+
+    def _on_evict(self, priority):
+        self._age = priority[0]
+
+
+class ARCPolicy(EvictionPolicy):
+    # Adaptive Replacement Cache weighted by the file sizes, T1 have the
+    # files accessed once since they were cached and T2 the ones accessed
+    # more times, B1 and B2 the ids recently evicted from them. The target
+    # size of T1 is adapted with the hits in the evicted ones.
+    def __init__(self, capacity):
+        self._capacity = capacity
+        self._p = 0
+        self._t1 = OrderedDict()
+        self._t2 = OrderedDict()
+        self._b1 = OrderedDict()
+        self._b2 = OrderedDict()
+        self._t1_bytes = 0
+        self._t2_bytes = 0
+        self._b1_bytes = 0
+        self._b2_bytes = 0
+
+    def add(self, id, size, ts, count):
+        self.remove(id)
+        if id in self._b1:
+            delta = max(self._b2_bytes / max(self._b1_bytes, 1), 1) * size
+            self._p = min(self._p + delta, self._capacity)
+            self._b1_bytes -= self._b1.pop(id)
+            self._push_t2(id, size)
+        elif id in self._b2:
+            delta = max(self._b1_bytes / max(self._b2_bytes, 1), 1) * size
+            self._p = max(self._p - delta, 0)
+            self._b2_bytes -= self._b2.pop(id)
+            self._push_t2(id, size)
+        elif count > 1:
+            self._push_t2(id, size)
+        else:
+            self._t1[id] = size
+            self._t1_bytes += size
+
+    def _push_t2(self, id, size):
+        self._t2[id] = size
+        self._t2_bytes += size
+
+    def access(self, id, ts):
+        if id in self._t1:
+            size = self._t1.pop(id)
+            self._t1_bytes -= size
+            self._push_t2(id, size)
+        elif id in self._t2:
+            self._t2.move_to_end(id)
+
+    def remove(self, id):
+        if id in self._t1:
+            self._t1_bytes -= self._t1.pop(id)
+        elif id in self._t2:
+            self._t2_bytes -= self._t2.pop(id)
+
+    def pop(self):
+        if self._t1 and (self._t1_bytes > self._p or not self._t2):
+            id, size = self._t1.popitem(last=False)
+            self._t1_bytes -= size
+            self._b1[id] = size
+            self._b1_bytes += size
+        elif self._t2:
+            id, size = self._t2.popitem(last=False)
+            self._t2_bytes -= size
+            self._b2[id] = size
+            self._b2_bytes += size
+        else:
+            return None
+        self._trim_ghosts()
+        return id
+
+    def _trim_ghosts(self):
+        while self._b1 and self._b1_bytes > self._capacity:
+            self._b1_bytes -= self._b1.popitem(last=False)[1]
+        while self._b2 and self._b2_bytes > self._capacity:
+            self._b2_bytes -= self._b2.popitem(last=False)[1]
+
+
+POLICIES = {
+    'lru': lambda capacity: LRUPolicy(),
+    'lfu': lambda capacity: LFUPolicy(),
+    'gdsf': lambda capacity: GDSFPolicy(),
+    'arc': ARCPolicy,
+}
+
+
+def create_policy(name, capacity):
+    return POLICIES[name](capacity)
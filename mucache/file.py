@@ -1,21 +1,40 @@
 #!/usr/bin/env python3
+import os
+import os.path
 import time
 from threading import Lock
 
-from .file_chunks import FileChunks
-from .read_strategy import CacheReadStrategy, DirectReadStrategy, ReadStrategy
+from .file_chunks import BITMAP_SUFFIX, FileChunks
+from .metrics import REGISTRY
+from .prefetch_controller import PrefetchController
+from .ram_cache import RamCacheReadStrategy
+from .read_ahead import ReadAhead
+from .read_strategy import (READ_BYTES, READS, CacheReadStrategy,
+                            DirectReadStrategy, LazyReadStrategy, ReadStrategy)
 from .types import State
 
 MB = 1024 * 1024
 
+PM_ACQUIRE_SECONDS = REGISTRY.histogram(
+    'mucache_power_manager_acquire_seconds',
+    "Time waiting for the power manager to open a file")
+
+_CACHED_HITS = READS.labels('cached', 'hit')
+_CACHED_HIT_BYTES = READ_BYTES.labels('cached', 'hit')
+_NO_CACHED_HITS = READS.labels('no_cached', 'hit')
+_NO_CACHED_HIT_BYTES = READ_BYTES.labels('no_cached', 'hit')
+_NO_CACHED_MISSES = READS.labels('no_cached', 'miss')
+_NO_CACHED_MISS_BYTES = READ_BYTES.labels('no_cached', 'miss')
+
 
 class BytesReaden:
-    def __init__(self):
+    def __init__(self, clock=time.time):
+        self._clock = clock
         self._expiration_ts: int = 0
         self._value: int = 0
 
     def incr(self, v):
-        t = int(time.time())
+        t = int(self._clock())
         if self._expiration_ts < t:
             self._expiration_ts = t + 300
         self._value += v
@@ -23,18 +42,36 @@ class BytesReaden:
 
 
 class File(ReadStrategy):
-    def __init__(self, src_path, dst_path, state, size, power_manager):
+    def __init__(self, src_path, dst_path, state, size, power_manager,
+                 read_ahead_chunks=0, chunk_sizer=None, io_scheduler=None,
+                 duration=None, playback_lead_sec=0, passthrough_bytes=None,
+                 copier=None, segment=None, id=None, ram_cache=None,
+                 clock=time.time):
         self._src_path = src_path
         self._dst_path = dst_path
         self._state = state
         self._size = size
         self._power_manager = power_manager
+        self._read_ahead_chunks = read_ahead_chunks
+        self._chunk_sizer = chunk_sizer
+        self._io_scheduler = io_scheduler
+        self._duration = duration
+        self._playback_lead_sec = playback_lead_sec
+        self._copier = copier
+        # The pinned head and tail of the file, that can be read without
+        # turning on the remote
+        self._segment = segment
+        self._id = id
+        self._ram_cache = ram_cache
 
-        self._passthrow_limit = max(16 * MB, min(0.15 * size, 64 * MB))
+        if passthrough_bytes is None:
+            passthrough_bytes = max(16 * MB, min(0.15 * size, 64 * MB))
+        self._passthrow_limit = passthrough_bytes
         self._lock = Lock()
         self._rc = 0
-        self._bytes_readen = BytesReaden()
+        self._bytes_readen = BytesReaden(clock)
         self._strategy = None
+        self._power_acquired = False
 
     def size(self):
         return self._size
@@ -42,11 +79,17 @@ class File(ReadStrategy):
     def state(self):
         return self._state
 
+    # Take a reference before opening the file, so it's possible to do it
+    # atomically with the lookup of the file and open it later without
+    # holding other locks
+    def retain(self):
+        with self._lock:
+            self._rc += 1
+
     def open(self):
         with self._lock:
-            if self._rc == 0:
+            if self._strategy is None:
                 self._open()
-            self._rc += 1
 
     def _open(self):
         ctor_by_state = {
@@ -56,55 +99,153 @@ class File(ReadStrategy):
         }
         self._strategy = ctor_by_state[self._state]()
 
-    def _open_no_cached(self):
+    def _acquire_power_manager(self):
+        start_ts = time.perf_counter()
         self._power_manager.acquire()
+        self._power_acquired = True
+        PM_ACQUIRE_SECONDS.observe(time.perf_counter() - start_ts)
+
+    def _release_power_manager(self):
+        if self._power_acquired:
+            self._power_acquired = False
+            self._power_manager.release()
+
+    def _open_no_cached(self):
+        # Don't turn on the remote until a read out of the pinned segments
+        if self._segment is not None:
+            return LazyReadStrategy(self._open_source)
+        return self._open_source()
+
+    def _open_source(self):
+        self._acquire_power_manager()
 
         return DirectReadStrategy(
-            open(self._src_path, 'rb'),
+            open(self._src_path, 'rb', buffering=0),
+            self._io_scheduler,
         )
 
     def _open_caching(self):
-        self._power_manager.acquire()
+        self._acquire_power_manager()
 
-        with open(self._dst_path, 'wb') as f:
-            f.seek(self._size)
-            f.write(b'\0')
-            f.truncate(self._size)
+        bitmap_path = f"{self._dst_path}{BITMAP_SUFFIX}"
+        if not self._can_resume_caching(bitmap_path):
+            with open(self._dst_path, 'wb') as f:
+                f.seek(self._size)
+                f.write(b'\0')
+                f.truncate(self._size)
+            if os.path.exists(bitmap_path):
+                os.remove(bitmap_path)
 
+        if self._chunk_sizer is not None:
+            chunks = FileChunks(
+                self._size,
+                chunk_size_bits=self._chunk_sizer.get_bits(self._size),
+                bitmap_path=bitmap_path,
+                copier=self._copier,
+                chunk_sizer=self._chunk_sizer,
+                io_scheduler=self._io_scheduler,
+            )
+        else:
+            chunks = FileChunks(self._size, bitmap_path=bitmap_path,
+                                copier=self._copier,
+                                io_scheduler=self._io_scheduler)
+        if self._read_ahead_chunks > 0:
+            read_ahead = ReadAhead(self._src_path, self._dst_path, chunks,
+                                   max_window=self._read_ahead_chunks)
+        else:
+            read_ahead = None
+        if self._playback_lead_sec > 0 and self._duration:
+            prefetch_controller = PrefetchController(
+                self._src_path, self._dst_path, self._size, self._duration,
+                chunks,
+                lead_sec=self._playback_lead_sec,
+                chunk_sizer=self._chunk_sizer,
+            )
+        else:
+            prefetch_controller = None
+
+        # Without buffering to see the chunks written by the read ahead
         return CacheReadStrategy(
-            open(self._src_path, 'rb'),
-            open(self._dst_path, 'rb+'),
-            FileChunks(self._size),
+            open(self._src_path, 'rb', buffering=0),
+            open(self._dst_path, 'rb+', buffering=0),
+            chunks,
+            read_ahead,
+            prefetch_controller,
         )
 
+    def _can_resume_caching(self, bitmap_path):
+        try:
+            return os.path.getsize(self._dst_path) == self._size \
+                and os.path.exists(bitmap_path)
+        except FileNotFoundError:
+            return False
+
     def _open_cached(self):
-        return DirectReadStrategy(
-            open(self._dst_path, 'rb'),
-        )
+        fd = open(self._dst_path, 'rb', buffering=0)
+        if self._ram_cache is not None:
+            return RamCacheReadStrategy(fd, self._id, self._size,
+                                        self._ram_cache)
+        return DirectReadStrategy(fd)
 
     def read(self, length, offset):
+        # The cached files don't change of strategy until the last close,
+        # and the positional reads can be done concurrently without lock
+        if self._state == State.CACHED:
+            data = self._strategy.read(length, offset)
+            _CACHED_HITS.inc()
+            _CACHED_HIT_BYTES.inc(len(data))
+            return (False, data)
+        # The pinned segments don't change and don't count to start caching
+        if self._segment is not None and self._state == State.NO_CACHED \
+                and self._segment.contains(length, offset):
+            data = self._segment.read(length, offset)
+            _NO_CACHED_HITS.inc()
+            _NO_CACHED_HIT_BYTES.inc(len(data))
+            return (False, data)
+
         with self._lock:
             start_caching = False
-            if self._state == State.NO_CACHED:
+            passthrough = self._state == State.NO_CACHED
+            if passthrough:
                 bytes_readen = self._bytes_readen.incr(length)
                 if bytes_readen >= self._passthrow_limit:
                     self._change_state_to_caching()
                     start_caching = True
+                    passthrough = False
             data = self._strategy.read(length, offset)
+            if passthrough:
+                _NO_CACHED_MISSES.inc()
+                _NO_CACHED_MISS_BYTES.inc(len(data))
             return (start_caching, data)
 
     def cache_next_chunk(self):
         with self._lock:
             if self._state == State.NO_CACHED:
                 self._change_state_to_caching()
-            if self._state == State.CACHING:
-                if not self._strategy.cache_next_chunk():
-                    self._close()
-                    self._state = State.CACHED
-                    self._open()
             if self._state == State.CACHED:
                 return False
-            return True
+            strategy = self._strategy
+        # The copy waits for the I/O scheduler and the prefetch bandwidth
+        # limit without the lock, so the reads of the file don't wait behind
+        # it. The reference of the caller keeps the strategy open.
+        pending = strategy.cache_next_chunk()
+        with self._lock:
+            if not pending and self._strategy is strategy:
+                self._change_state_to_cached()
+            return self._state != State.CACHED
+
+    def is_lead_safe(self):
+        with self._lock:
+            return self._state == State.CACHING and self._strategy.is_lead_safe()
+
+    def _change_state_to_cached(self):
+        # Publish the new strategy before the state, so the reads without
+        # lock that see the cached state always use it
+        strategy = self._strategy
+        self._strategy = self._open_cached()
+        self._state = State.CACHED
+        self._release_power_manager()
+        strategy.close()
 
     def _change_state_to_caching(self):
         self._close()
@@ -114,12 +255,11 @@ class File(ReadStrategy):
     def close(self):
         with self._lock:
             self._rc -= 1
-            if self._rc == 0:
+            if self._rc == 0 and self._strategy is not None:
                 self._close()
             return self._rc == 0
 
     def _close(self):
-        if self._state in (State.NO_CACHED, State.CACHING):
-            self._power_manager.release()
+        self._release_power_manager()
         self._strategy.close()
         self._strategy = None
@@ -3,9 +3,12 @@ import logging
 import os
 import os.path
 import stat
+from itertools import count
 
 from exiftool import ExifTool
 
+from .file_chunks import BITMAP_SUFFIX
+from .indexer import TreeIndexer
 from .types import ST_KEYS, Entry
 
 IN_MOVED_FROM    = 0x00000040
@@ -23,9 +26,20 @@ def check_flag(mask, *options):
 
 
 class FileBuilder:
-    def __init__(self, path, storage, proxy, power_manager):
+    def __init__(self, path, storage, proxy, power_manager, index=None,
+                 scan_workers=8, exif_workers=4, duration_extractor=None,
+                 attr_cache=None, negative_cache=None, segment_pinner=None,
+                 cache_path=None):
         self._path = path
+        self._cache_path = cache_path
         self._storage = storage
+        self._index = index
+        self._duration_extractor = duration_extractor
+        self._attr_cache = attr_cache
+        self._negative_cache = negative_cache
+        self._segment_pinner = segment_pinner
+        self._scan_workers = scan_workers
+        self._exif_workers = exif_workers
         self._proxy = proxy
         self._power_manager = power_manager
         self._next_id = self._storage.get_largest_id() + 1
@@ -34,22 +48,129 @@ class FileBuilder:
         if check_flag(e.mask, IN_MOVED_FROM, IN_DELETE):
             p = os.path.join('/', e.path, e.name)
             self._del_path(p)
+            if self._attr_cache is not None:
+                self._attr_cache.invalidate(p)
         if check_flag(e.mask, IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE):
             p = os.path.join('/', e.path)
             parent_id = self._storage.get_id(p)
             if parent_id is not None:
                 relpath = os.path.join(self._path, e.path, e.name)
+                # The path is added again with a new id
+                if self._segment_pinner is not None:
+                    old_id = self._storage.get_id(os.path.join(p, e.name))
+                    if old_id is not None:
+                        self._segment_pinner.remove(old_id)
                 self._setup_and_add_path(parent_id, relpath)
+            if self._attr_cache is not None:
+                self._attr_cache.invalidate(os.path.join(p, e.name))
+            if self._negative_cache is not None:
+                self._negative_cache.invalidate(os.path.join(p, e.name))
         if self._proxy is not None:
             self._proxy.notify(e)
 
     def rebuild(self):
         logger.debug("Indexing files")
         self._storage.purge()
-        self._next_id = 0
-        self._setup_and_add_path(-1, self._path)
+        if self._index is not None:
+            self._index.clear()
+        if self._attr_cache is not None:
+            self._attr_cache.clear()
+        if self._negative_cache is not None:
+            self._negative_cache.clear()
+        # The ids change with the rebuild
+        if self._segment_pinner is not None:
+            self._segment_pinner.clear()
+        ids = count(0)
+
+        def create_entry(parent_id, path, fstat):
+            return (self._create(next(ids), parent_id, path, None, fstat=fstat), True)
+
+        self._index_tree(create_entry)
+        self._next_id = next(ids)
+
+    def resync(self):
+        logger.debug("Resyncing the indexed files")
+        if self._attr_cache is not None:
+            self._attr_cache.clear()
+        if self._negative_cache is not None:
+            self._negative_cache.clear()
+        rows = {row[0]: row[1:] for row in self._storage.get_sync_entries()}
+        ids = count(self._next_id)
+        changed_ids = []
+
+        # Keep the id, state and accesses of the unchanged paths, and only
+        # the id and accesses of the modified ones
+        def create_entry(parent_id, path, fstat):
+            row = rows.pop(self._get_relpath(path), None)
+            if row is None:
+                return (self._create(next(ids), parent_id, path, None, fstat=fstat), True)
+            id, old_parent_id, st_mode, st_size, st_mtime, last_access_ts, access_count = row
+            e = self._create(id, parent_id, path, None, fstat=fstat)
+            changed = (old_parent_id, st_mode, st_size, st_mtime) \
+                != (parent_id, fstat.st_mode, fstat.st_size, fstat.st_mtime)
+            if changed:
+                e.last_access_ts = last_access_ts
+                e.access_count = access_count
+                changed_ids.append(id)
+            return (e, changed)
+
+        failed_paths = self._index_tree(create_entry)
+        self._next_id = next(ids)
+        # The modified files keep their ids, but not the cached data
+        self._remove_cache_files(changed_ids)
+
+        # Don't remove the paths that weren't scanned due to an error
+        failed_relpaths = [self._get_relpath(p) for p in failed_paths]
+        failed_prefixes = tuple(p.rstrip('/') + '/' for p in failed_relpaths)
+        removed_ids = [row[0] for path, row in rows.items()
+                       if path not in failed_relpaths
+                       and not path.startswith(failed_prefixes)]
+        logger.debug(f"Removing {len(removed_ids)} entries that no longer exist")
+        self._storage.remove_entries(removed_ids)
+        if self._index is not None:
+            for id in removed_ids:
+                self._index.remove(id)
+        if self._segment_pinner is not None:
+            for id in removed_ids:
+                self._segment_pinner.remove(id)
+
+    def _remove_cache_files(self, ids):
+        if self._cache_path is None:
+            return
+        for id in ids:
+            path = os.path.join(self._cache_path, str(id))
+            for p in (path, f"{path}{BITMAP_SUFFIX}"):
+                try:
+                    os.remove(p)
+                except FileNotFoundError:
+                    pass
+
+    def _index_tree(self, create_entry):
+        indexer = TreeIndexer(
+            create_entry,
+            self._add_entries,
+            scan_workers=self._scan_workers,
+            exif_workers=self._exif_workers,
+        )
+        try:
+            self._power_manager.acquire()
+            return indexer.index(-1, self._path)
+        finally:
+            self._power_manager.release()
 
     def _setup_and_add_path(self, parent_id, path):
+        # Publish the entries before extracting the durations in background
+        if self._duration_extractor is not None:
+            try:
+                self._power_manager.acquire()
+                entries = self._add_path(parent_id, path, None)
+            finally:
+                self._power_manager.release()
+            for e in entries:
+                if e.pending_duration:
+                    self._duration_extractor.add(e.id, e.path)
+            return
+
         with ExifTool() as exif_tool:
             try:
                 self._power_manager.acquire()
@@ -71,7 +192,15 @@ class FileBuilder:
                         to_check.append((self._next_id, entry.path, entry.stat()))
             self._next_id += 1
 
+        self._add_entries(entries)
+        return entries
+
+    def _add_entries(self, entries):
         self._storage.replace_entries(entries)
+        if self._index is not None:
+            self._index.add_entries(entries)
+        if self._segment_pinner is not None:
+            self._segment_pinner.add_entries(entries)
 
     def _del_path(self, relpath):
         id = self._storage.get_id(relpath)
@@ -85,23 +214,32 @@ class FileBuilder:
             children_ids = self._storage.get_children_ids(id)
             ids_to_remove.extend(children_ids or [])
             self._storage.remove_entry(id)
+            if self._index is not None:
+                self._index.remove(id)
+            if self._segment_pinner is not None:
+                self._segment_pinner.remove(id)
 
     def _create(self, id, parent_id, path, exif_tool, fstat=None):
         logger.debug(f"Creating entry of path '{path}' with id {id}")
         data = {}
         data['id'] = id
         data['parent_id'] = parent_id
-        relpath = os.path.relpath(path, start=self._path)
-        relpath = '/' if relpath == '.' else f"/{relpath}"
-        data['path'] = relpath
+        data['path'] = self._get_relpath(path)
         data['name'] = os.path.basename(path)
 
         if fstat is None:
             fstat = os.stat(path)
         if stat.S_ISREG(fstat.st_mode):
-            data['duration'] = exif_tool.get_tag('Duration', path)
+            if exif_tool is not None:
+                data['duration'] = exif_tool.get_tag('Duration', path)
+            else:
+                data['pending_duration'] = True
         for key in ST_KEYS:
             data[key] = getattr(fstat, key)
         data['st_ino'] = id
 
         return Entry(**data)
+
+    def _get_relpath(self, path):
+        relpath = os.path.relpath(path, start=self._path)
+        return '/' if relpath == '.' else f"/{relpath}"
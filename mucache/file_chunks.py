@@ -1,42 +1,227 @@
 #!/usr/bin/env python3
+import logging
+import os
+import struct
+import time
+from threading import Condition, Lock
+
+from .chunk_copier import DEFAULT_COPIER
+from .io_scheduler import IOClass
+
+BITMAP_SUFFIX = '.chunks'
+
+logger = logging.getLogger(__name__)
+
 
 class FileChunks:
-    def __init__(self, size, chunk_size_bits=18):
-        self._num_chunks = ((size-1) >> chunk_size_bits) + 1
-        self._chunk_size_bits = chunk_size_bits
+    # The bitmap file starts with the file size and the chunk size bits to
+    # detect when it doesn't correspond to the current chunks layout
+    _HEADER = struct.Struct('<QB')
+
+    def __init__(self, size, chunk_size_bits=18, bitmap_path=None,
+                 save_every_chunks=64, save_every_sec=10, copier=None,
+                 chunk_sizer=None, io_scheduler=None):
+        self._size = size
+        self._bitmap_path = bitmap_path
+        self._save_every_chunks = save_every_chunks
+        self._save_every_sec = save_every_sec
+        self._copier = DEFAULT_COPIER if copier is None else copier
+        self._chunk_sizer = chunk_sizer
+        self._io_scheduler = io_scheduler
+
+        # A resumed file keeps the chunk size used when it started caching
+        self._chunk_size_bits, self._bitmap = self._load_bitmap(chunk_size_bits)
+        self._num_chunks = self._get_num_chunks(self._chunk_size_bits)
+        # The first chunk that isn't cached yet
         self._next_chunk = 0
-        self._cached_chunks = set()
+        self._advance_next_chunk()
+        # The chunks being copied, the access to them must wait until the
+        # copy ends because they can be filled from several threads
+        self._copying_chunks = set()
+        self._cond = Condition()
+
+        self._save_lock = Lock()
+        self._unsaved_chunks = 0
+        self._saved_ts = time.monotonic()
 
+    def _get_num_chunks(self, chunk_size_bits):
+        return ((self._size-1) >> chunk_size_bits) + 1
+
+    def chunk_size_bits(self):
+        return self._chunk_size_bits
+
+    def num_chunks(self):
+        return self._num_chunks
+
+    def _is_set(self, i):
+        return self._bitmap[i >> 3] & (1 << (i & 7))
+
+    def _set(self, i):
+        self._bitmap[i >> 3] |= 1 << (i & 7)
+
+    def first_missing_chunk(self, a, b):
+        with self._cond:
+            b = min(b, self._num_chunks - 1)
+            for i in range(max(a, self._next_chunk), b + 1):
+                if not self._is_set(i) and i not in self._copying_chunks:
+                    return i
+            return None
+
+    def _advance_next_chunk(self):
+        i = self._next_chunk
+        while i < self._num_chunks:
+            if self._bitmap[i >> 3] == 0xff:
+                i = (i | 7) + 1
+            elif self._is_set(i):
+                i += 1
+            else:
+                break
+        self._next_chunk = min(i, self._num_chunks)
+
+    # Return if some chunk wasn't in the cache
     def ensure_in_cache(self, src_fd, dst_fd, length, offset):
         a = offset >> self._chunk_size_bits
         b = (offset+length) >> self._chunk_size_bits
+        return self.ensure_chunks_in_cache(src_fd, dst_fd, a, b)
+
+    def ensure_chunks_in_cache(self, src_fd, dst_fd, a, b,
+                               io_class=IOClass.ON_DEMAND):
+        b = min(b, self._num_chunks - 1)
+        missed = False
         while a <= b:
-            if a >= self._next_chunk and a not in self._cached_chunks:
-                self._copy_chunk(src_fd, dst_fd, a)
-                if a == self._next_chunk:
-                    self._next_chunk += 1
-                else:
-                    self._cached_chunks.add(a)
+            copy, cached = self._start_copy(a)
+            if copy:
+                self._copy(src_fd, dst_fd, a, io_class)
+            missed = missed or not cached
             a += 1
+        return missed
+
+    # Return if the chunk has to be copied and if it was already cached
+    def _start_copy(self, i):
+        with self._cond:
+            cached = True
+            while i in self._copying_chunks:
+                cached = False
+                self._cond.wait()
+            if self._is_set(i):
+                return (False, cached)
+            self._copying_chunks.add(i)
+            return (True, False)
+
+    def _copy(self, src_fd, dst_fd, i, io_class):
+        copied = False
+        try:
+            self._copy_chunk(src_fd, dst_fd, i, io_class)
+            copied = True
+        finally:
+            with self._cond:
+                self._copying_chunks.discard(i)
+                if copied:
+                    self._set(i)
+                    self._unsaved_chunks += 1
+                    if i == self._next_chunk:
+                        self._advance_next_chunk()
+                self._cond.notify_all()
+        self._maybe_save_bitmap(dst_fd)
+
+    def cache_next_chunk(self, src_fd, dst_fd, io_class=IOClass.PREFETCH):
+        with self._cond:
+            while True:
+                chunk_to_cache = self._next_chunk
+                if chunk_to_cache >= self._num_chunks:
+                    return False
+                if chunk_to_cache not in self._copying_chunks:
+                    break
+                self._cond.wait()
+            self._copying_chunks.add(chunk_to_cache)
+        self._copy(src_fd, dst_fd, chunk_to_cache, io_class)
+        with self._cond:
+            return self._next_chunk < self._num_chunks
+
+    def _copy_chunk(self, src_fd, dst_fd, i, io_class):
+        if self._io_scheduler is None:
+            self._copy_chunk_data(src_fd, dst_fd, i)
+            return
+        with self._io_scheduler.request(io_class, 1 << self._chunk_size_bits):
+            self._copy_chunk_data(src_fd, dst_fd, i)
 
-    def cache_next_chunk(self, src_fd, dst_fd):
-        while self._next_chunk < self._num_chunks:
-            chunk_to_cache = self._next_chunk
-            self._next_chunk += 1
-            if chunk_to_cache in self._cached_chunks:
-                self._cached_chunks.discard(chunk_to_cache)
+    def _copy_chunk_data(self, src_fd, dst_fd, i):
+        # Only the copy is measured, without the wait for the scheduler
+        start_ts = time.perf_counter()
+        n_bytes = self._copier.copy(
+            src_fd.fileno(),
+            dst_fd.fileno(),
+            i << self._chunk_size_bits,
+            1 << self._chunk_size_bits,
+        )
+        if self._chunk_sizer is not None:
+            self._chunk_sizer.record(n_bytes, time.perf_counter() - start_ts)
+
+    def _load_bitmap(self, chunk_size_bits):
+        if self._bitmap_path is not None:
+            try:
+                with open(self._bitmap_path, 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                data = None
+            if data is not None:
+                bitmap = self._parse_bitmap(data)
+                if bitmap is not None:
+                    return bitmap
+                logger.warning(f"Ignoring the invalid chunks bitmap '{self._bitmap_path}'")
+        n_bytes = (self._get_num_chunks(chunk_size_bits) + 7) >> 3
+        return (chunk_size_bits, bytearray(n_bytes))
+
+    def _parse_bitmap(self, data):
+        if len(data) < self._HEADER.size:
+            return None
+        size, chunk_size_bits = self._HEADER.unpack_from(data)
+        n_bytes = (self._get_num_chunks(chunk_size_bits) + 7) >> 3
+        if size != self._size or len(data) != self._HEADER.size + n_bytes:
+            return None
+        return (chunk_size_bits, bytearray(data[self._HEADER.size:]))
+
+    def _maybe_save_bitmap(self, dst_fd):
+        if self._bitmap_path is None:
+            return
+        with self._cond:
+            if self._unsaved_chunks == 0:
+                return
+            if self._unsaved_chunks < self._save_every_chunks \
+                    and time.monotonic() - self._saved_ts < self._save_every_sec:
+                return
+        # Other thread is already saving it
+        if self._save_lock.acquire(blocking=False):
+            # It's only a checkpoint, it must not fail the read
+            try:
+                self._save_bitmap(dst_fd)
+            except:
+                logger.exception(f"Error saving the chunks bitmap '{self._bitmap_path}'")
+            finally:
+                self._save_lock.release()
+
+    def _save_bitmap(self, dst_fd=None):
+        with self._cond:
+            data = self._HEADER.pack(self._size, self._chunk_size_bits) \
+                + bytes(self._bitmap)
+            self._unsaved_chunks = 0
+            self._saved_ts = time.monotonic()
+        # The chunks must be in disk before being marked as cached
+        if dst_fd is not None:
+            os.fsync(dst_fd.fileno())
+        tmp_path = f"{self._bitmap_path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self._bitmap_path)
+
+    def close(self, dst_fd=None):
+        if self._bitmap_path is None:
+            return
+        with self._save_lock:
+            if self._next_chunk >= self._num_chunks:
+                try:
+                    os.remove(self._bitmap_path)
+                except FileNotFoundError:
+                    pass
             else:
-                self._copy_chunk(src_fd, dst_fd, chunk_to_cache)
-                return self._next_chunk < self._num_chunks
-        return False
-
-    def _copy_chunk(self, src_fd, dst_fd, i):
-        src_fd.seek(i << self._chunk_size_bits)
-        dst_fd.seek(i << self._chunk_size_bits)
-        size = 1 << self._chunk_size_bits
-        while size > 0:
-            chunk = src_fd.read(size)
-            if not chunk:
-                break
-            dst_fd.write(chunk)
-            size -= len(chunk)
+                self._save_bitmap(dst_fd)
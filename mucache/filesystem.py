@@ -2,19 +2,29 @@
 import logging
 import os
 import os.path
+import sys
 import time
-from queue import Queue
-from threading import Lock, Thread
+from itertools import count
+from queue import PriorityQueue
+from threading import Condition, Lock, Thread
 
 from .file import File
 from .types import State
 
 logger = logging.getLogger(__name__)
 
+# The priority of the played files put back in the queue, after the rest
+DEFERRED = sys.maxsize
+
 
 class Filesystem:
     def __init__(self, *, src_path, dst_path, storage, power_manager,
-                 cleaner, prefetch_sec, prefetch_bytes):
+                 cleaner, prefetch_sec, prefetch_bytes, prefetch_workers=1,
+                 read_ahead_chunks=0, chunk_sizer=None, io_scheduler=None,
+                 playback_lead_sec=0, passthrough_bytes=None, copier=None,
+                 attr_cache=None, negative_cache=None, segment_store=None,
+                 ram_cache=None, index=None, write_buffer=None,
+                 clock=time.time):
         self._src_path = src_path
         self._dst_path = dst_path
         self._storage = storage
@@ -22,49 +32,128 @@ class Filesystem:
         self._cleaner = cleaner
         self._prefetch_sec = prefetch_sec
         self._prefetch_bytes = prefetch_bytes
+        self._prefetch_workers = prefetch_workers
+        self._read_ahead_chunks = read_ahead_chunks
+        self._chunk_sizer = chunk_sizer
+        self._io_scheduler = io_scheduler
+        self._playback_lead_sec = playback_lead_sec
+        self._passthrough_bytes = passthrough_bytes
+        self._copier = copier
+        self._attr_cache = attr_cache
+        self._negative_cache = negative_cache
+        self._segment_store = segment_store
+        self._ram_cache = ram_cache
+        self._index = index
+        self._write_buffer = write_buffer
+        self._clock = clock
+        # The access timestamps and prefetch states are written through the
+        # buffer when there is one
+        self._writer = storage if write_buffer is None else write_buffer
         self._lock = Lock()
         self._files_by_id = {}
-        self._loop_queue = Queue()
-        self._thread = None
+        self._caching_ids = set()
+        # The items are sorted by position in the batch and newest batch
+        # first, so the next file of the one being played goes first
+        self._loop_queue = PriorityQueue()
+        self._loop_batch_seq = count()
+        # The queued files that aren't cached yet
+        self._pending = 0
+        self._idle = Condition(self._lock)
+        self._threads = []
 
     def get_attr(self, path):
-        return self._storage.get_attr(path)
-
-    def read_dir(self, path):
-        id = self._storage.get_id(path)
-        if id is None:
-            return None
-        names = self._storage.get_children_names(id)
-        if names is None:
-            return None
-        names.sort()
-        return names
+        if self._attr_cache is not None:
+            attrs = self._attr_cache.get(path)
+            if attrs is not None:
+                return attrs
+        if self._negative_cache is not None:
+            if self._negative_cache.contains(path):
+                return None
+            generation = self._negative_cache.generation()
+        if self._index is not None:
+            attrs = self._index.get_attr(path)
+        else:
+            attrs = self._storage.get_attr(path)
+        if attrs is None and self._negative_cache is not None:
+            self._negative_cache.add(path, generation)
+        return attrs
+
+    # Return the names and attributes of the children of a dir, keeping
+    # the attributes for the getattr calls of the listed entries
+    def read_dir_attrs(self, path):
+        if self._index is not None:
+            id = self._index.get_id(path)
+            if id is None:
+                return None
+            children = self._index.get_children_attrs(id)
+        else:
+            id = self._storage.get_id(path)
+            if id is None:
+                return None
+            children = self._storage.get_children_attrs(id)
+            if children is None:
+                return None
+        if self._attr_cache is not None:
+            self._attr_cache.put_many((p, attrs) for _, p, attrs in children)
+        return [(name, attrs) for name, _, attrs in children]
 
     def open(self, path):
         with self._lock:
             f, fid = self._touch_file(path)
             if f is None:
                 return None
-        f.open()
+            f.retain()
+        self._open(f, fid)
         return fid
 
-    def _touch_file(self, path):
+    def _open(self, f, fid):
+        try:
+            f.open()
+        except:
+            with self._lock:
+                self._close(f, fid)
+            raise
+
+    def _touch_file(self, path, access=True):
         fid, state, size = self._storage.get_id_state_size(path)
         if fid is None:
             return (None, None)
         f = self._get_file(fid, path, state, size)
-        self._storage.set_last_access_ts(fid, int(time.time()))
+        ts = int(self._clock())
+        # The opens to prefetch a file don't count as accesses
+        if access:
+            self._writer.touch(fid, ts)
+            self._cleaner.on_access(fid, ts)
+        else:
+            self._writer.set_last_access_ts(fid, ts)
         return (f, fid)
 
     def _get_file(self, id, path, state, size):
         f = self._files_by_id.get(id)
         if f is None:
+            duration = None
+            if self._playback_lead_sec > 0 and state != State.CACHED:
+                duration = self._storage.get_duration(id)
+            segment = None
+            if self._segment_store is not None and state == State.NO_CACHED:
+                segment = self._segment_store.load(id, size)
             f = File(
                 os.path.join(self._src_path, path[1:]),
                 os.path.join(self._dst_path, str(id)),
                 state,
                 size,
-                self._power_manager
+                self._power_manager,
+                read_ahead_chunks=self._read_ahead_chunks,
+                chunk_sizer=self._chunk_sizer,
+                io_scheduler=self._io_scheduler,
+                duration=duration,
+                playback_lead_sec=self._playback_lead_sec,
+                passthrough_bytes=self._passthrough_bytes,
+                copier=self._copier,
+                segment=segment,
+                id=id,
+                ram_cache=self._ram_cache,
+                clock=self._clock,
             )
             self._files_by_id[id] = f
             if state == State.CACHED and size < self._prefetch_bytes:
@@ -90,12 +179,25 @@ class Filesystem:
             self._prefetch_sec,
             self._prefetch_bytes,
         )
-        ts = int(time.time())
+        ts = int(self._clock())
+        batch_seq = next(self._loop_batch_seq)
         for i, (fid, path, size) in enumerate(to_cache):
+            if self._write_buffer is not None \
+                    and self._write_buffer.has_pending_state(fid):
+                continue
             logger.debug(f"To precache the file '{path}' with id {fid}")
-            self._storage.set_last_access_ts(fid, ts-i)
-            self._storage.set_state(fid, State.NO_CACHED, State.CACHING)
-            self._loop_queue.put(path)
+            self._writer.set_last_access_ts(fid, ts-i)
+            self._writer.set_state(fid, State.NO_CACHED, State.CACHING)
+            self._pending += 1
+            self._loop_queue.put((i, -batch_seq, path))
+
+    def resume_caching(self):
+        with self._lock:
+            batch_seq = next(self._loop_batch_seq)
+            for i, path in enumerate(self._storage.get_state_paths(State.CACHING)):
+                logger.debug(f"To resume the caching of the file '{path}'")
+                self._pending += 1
+                self._loop_queue.put((i, -batch_seq, path))
 
     def close(self, fh):
         with self._lock:
@@ -110,28 +212,91 @@ class Filesystem:
             self._files_by_id.pop(id)
 
     def start(self):
-        self._thread = Thread(target=self._loop)
-        self._thread.start()
+        for _ in range(self._prefetch_workers):
+            t = Thread(target=self._loop)
+            t.start()
+            self._threads.append(t)
 
     def _loop(self):
         while True:
-            path = self._loop_queue.get()
+            _, _, path = self._loop_queue.get()
             if path is None:
                 break
-            with self._lock:
-                f, fid = self._touch_file(path)
-            if f is not None:
-                f.open()
-                self._cleaner.to_add(f.size())
-                logger.debug(f"Caching the file '{path}' with id {fid}")
-                while f.cache_next_chunk():
-                    pass
-                logger.debug(f"Cached the file '{path}' with id {fid}")
+            try:
+                self._cache_file(path)
+            except:
+                logger.exception(f"Error caching the file '{path}'")
+            finally:
                 with self._lock:
-                    self._storage.set_state(fid, State.CACHING, State.CACHED)
-                    self._close(f, fid)
+                    self._pending -= 1
+                    if self._pending == 0:
+                        self._idle.notify_all()
+
+    def _cache_file(self, path):
+        with self._lock:
+            f, fid = self._touch_file(path, access=False)
+            if f is None or fid in self._caching_ids:
+                return
+            self._caching_ids.add(fid)
+            f.retain()
+        try:
+            self._open(f, fid)
+        except:
+            logger.exception(f"Error opening the file '{path}' with id {fid} to cache it")
+            with self._lock:
+                self._caching_ids.discard(fid)
+            return
+        reserved = f.state() != State.CACHED
+        if reserved:
+            self._cleaner.to_add(f.size())
+        logger.debug(f"Caching the file '{path}' with id {fid}")
+        deferred = False
+        try:
+            while f.cache_next_chunk():
+                # The lead of a played file is kept by its reads, so the
+                # worker can continue with the next files
+                if f.is_lead_safe() and not self._loop_queue.empty():
+                    deferred = True
+                    break
+        except:
+            logger.exception(f"Error caching the file '{path}' with id {fid}")
+            # The cached chunks are kept to resume it in the next open
+            with self._lock:
+                self._writer.set_state(fid, State.CACHING, State.NO_CACHED)
+                if reserved:
+                    self._cleaner.cancel_add(f.size())
+                self._caching_ids.discard(fid)
+                self._close(f, fid)
+            return
+        if deferred:
+            logger.debug(f"Deferring the caching of the played file '{path}' with id {fid}")
+            with self._lock:
+                if reserved:
+                    self._cleaner.cancel_add(f.size())
+                self._caching_ids.discard(fid)
+                self._close(f, fid)
+                self._pending += 1
+                self._loop_queue.put((DEFERRED, next(self._loop_batch_seq), path))
+            return
+        logger.debug(f"Cached the file '{path}' with id {fid}")
+        # Write the pending change to caching before the cached one
+        if self._write_buffer is not None:
+            self._write_buffer.flush()
+        with self._lock:
+            self._storage.set_state(fid, State.CACHING, State.CACHED)
+            if reserved:
+                self._cleaner.on_cached(fid, f.size(), int(self._clock()))
+            self._caching_ids.discard(fid)
+            self._close(f, fid)
+
+    def wait_idle(self):
+        with self._lock:
+            while self._pending > 0:
+                self._idle.wait()
 
     def stop(self):
-        self._loop_queue.put(None)
-        self._thread.join()
-        self._thread = None
+        for _ in self._threads:
+            self._loop_queue.put((-1, 0, None))
+        for t in self._threads:
+            t.join()
+        self._threads = []
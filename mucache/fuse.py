@@ -1,35 +1,67 @@
 #!/usr/bin/env python3
 import errno
 import logging
+import time
 
 from fuse import FuseOSError, Operations
 
+from .metrics import REGISTRY
+
 logger = logging.getLogger(__name__)
 
+FUSE_OP_SECONDS = REGISTRY.histogram(
+    'mucache_fuse_op_seconds', "Duration of the FUSE operations", ['op'])
+FUSE_ERRORS = REGISTRY.counter(
+    'mucache_fuse_errors_total', "Number of FUSE operations that failed", ['op'])
+
+_OPS = ('getattr', 'readdir', 'open', 'read', 'release')
+_OP_SECONDS = {op: FUSE_OP_SECONDS.labels(op) for op in _OPS}
+_OP_ERRORS = {op: FUSE_ERRORS.labels(op) for op in _OPS}
+
+
+def _fail(op):
+    _OP_ERRORS[op].inc()
+    return FuseOSError(errno.ENOENT)
+
 
 class FuseWrapper(Operations):
-    def __init__(self, fs):
+    def __init__(self, fs, trace_recorder=None):
         self._fs = fs
+        self._trace_recorder = trace_recorder
 
     def getattr(self, path, fh=None):
         logger.debug('Obtaining the attributes of "%s"', path)
-        res = self._fs.get_attr(path)
+        start_ts = time.perf_counter()
+        try:
+            res = self._fs.get_attr(path)
+        finally:
+            _OP_SECONDS['getattr'].observe(time.perf_counter() - start_ts)
         if res is None:
-            raise FuseOSError(errno.ENOENT)
+            raise _fail('getattr')
         return res
 
     def readdir(self, path, fh):
         logger.debug('Reading the dir "%s"', path)
-        names = self._fs.read_dir(path)
-        if names is None:
-            raise FuseOSError(errno.ENOENT)
-        return ['.', '..'] + names
+        start_ts = time.perf_counter()
+        try:
+            children = self._fs.read_dir_attrs(path)
+        finally:
+            _OP_SECONDS['readdir'].observe(time.perf_counter() - start_ts)
+        if children is None:
+            raise _fail('readdir')
+        return ['.', '..'] + [(name, attrs, 0) for name, attrs in children]
 
     def open(self, path, flags):
         logger.debug('Opening the file "%s"', path)
-        fh = self._fs.open(path)
+        start_ts = time.perf_counter()
+        try:
+            fh = self._fs.open(path)
+        finally:
+            _OP_SECONDS['open'].observe(time.perf_counter() - start_ts)
         if fh is None:
-            raise FuseOSError(errno.ENOENT)
+            raise _fail('open')
+        if self._trace_recorder is not None:
+            self._trace_recorder.record_open(path, fh)
         return fh
 
     def read(self, path, length, offset, fh):
@@ -40,15 +72,28 @@ class FuseWrapper(Operations):
             offset,
             length
         )
-        data = self._fs.read(path, fh, length, offset)
+        if self._trace_recorder is not None:
+            self._trace_recorder.record_read(fh, offset, length)
+        start_ts = time.perf_counter()
+        try:
+            data = self._fs.read(path, fh, length, offset)
+        finally:
+            _OP_SECONDS['read'].observe(time.perf_counter() - start_ts)
         if data is None:
-            raise FuseOSError(errno.ENOENT)
+            raise _fail('read')
         return data
 
     def release(self, path, fh):
         logger.debug('Closing the file "%s" with fh %d', path, fh)
-        if not self._fs.close(fh):
-            raise FuseOSError(errno.ENOENT)
+        if self._trace_recorder is not None:
+            self._trace_recorder.record_release(fh)
+        start_ts = time.perf_counter()
+        try:
+            closed = self._fs.close(fh)
+        finally:
+            _OP_SECONDS['release'].observe(time.perf_counter() - start_ts)
+        if not closed:
+            raise _fail('release')
 
     # Disable unused operations
     create = None
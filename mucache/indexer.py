@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+import logging
+import os
+import stat
+from queue import Empty, Queue
+from threading import Lock, Thread
+
+from exiftool import ExifTool
+
+from .duration_extractor import parse_durations
+
+logger = logging.getLogger(__name__)
+
+
+class TreeIndexer:
+    # Index a tree with a pool of threads scanning the directories, a pool
+    # of exiftool processes extracting the durations of the regular files in
+    # batches and the caller thread writing the entries in bounded batches.
+    # The entries are created with `create_entry(parent_id, path, fstat)`,
+    # that returns the entry and if it changed, the unchanged ones are only
+    # used to continue scanning. Without exiftool workers the regular files
+    # are written without their durations.
+    def __init__(self, create_entry, write_entries, scan_workers=8,
+                 exif_workers=4, exif_batch_size=64, write_batch_size=1000):
+        self._create_entry = create_entry
+        self._write_entries = write_entries
+        self._scan_workers = scan_workers
+        self._exif_workers = exif_workers
+        self._exif_batch_size = exif_batch_size
+        self._write_batch_size = write_batch_size
+
+        self._dirs_queue = Queue()
+        self._pending_dirs = 0
+        self._pending_dirs_lock = Lock()
+        self._failed_paths = []
+        self._exif_queue = Queue(4 * exif_workers * exif_batch_size)
+        self._write_queue = Queue(4 * write_batch_size)
+
+    # Return the paths that couldn't be indexed
+    def index(self, parent_id, path):
+        path = os.path.abspath(path)
+        self._pending_dirs = 1
+        self._dirs_queue.put((parent_id, path, os.stat(path)))
+
+        threads = [Thread(target=self._scan_loop) for _ in range(self._scan_workers)]
+        threads += [Thread(target=self._exif_loop) for _ in range(self._exif_workers)]
+        for t in threads:
+            t.start()
+        try:
+            self._write_loop()
+        finally:
+            for t in threads:
+                t.join()
+        return self._failed_paths
+
+    def _scan_loop(self):
+        while True:
+            item = self._dirs_queue.get()
+            if item is None:
+                break
+            try:
+                self._scan(*item)
+            except:
+                logger.exception(f"Error indexing the path '{item[1]}'")
+                self._failed_paths.append(item[1])
+            finally:
+                with self._pending_dirs_lock:
+                    self._pending_dirs -= 1
+                    if self._pending_dirs == 0:
+                        for _ in range(self._scan_workers):
+                            self._dirs_queue.put(None)
+                        for _ in range(self._exif_workers):
+                            self._exif_queue.put(None)
+                        if self._exif_workers == 0:
+                            self._write_queue.put(None)
+
+    def _scan(self, parent_id, path, fstat):
+        e = self._add_path(parent_id, path, fstat)
+        if stat.S_ISDIR(e.st_mode):
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=True):
+                        with self._pending_dirs_lock:
+                            self._pending_dirs += 1
+                        self._dirs_queue.put((e.id, entry.path, entry.stat()))
+                    else:
+                        self._add_path(e.id, entry.path, entry.stat())
+
+    def _add_path(self, parent_id, path, fstat):
+        e, changed = self._create_entry(parent_id, path, fstat)
+        if changed:
+            if stat.S_ISREG(e.st_mode) and self._exif_workers > 0:
+                self._exif_queue.put((e, path))
+            else:
+                self._write_queue.put(e)
+        return e
+
+    def _exif_loop(self):
+        try:
+            exif_tool = ExifTool()
+            exif_tool.start()
+        except:
+            logger.exception("Error starting exiftool, the durations will be empty")
+            exif_tool = None
+        try:
+            self._process_exif_queue(exif_tool)
+        finally:
+            if exif_tool is not None:
+                exif_tool.terminate()
+            self._write_queue.put(None)
+
+    def _process_exif_queue(self, exif_tool):
+        # Each worker ends after getting one of the end marks
+        while True:
+            item = self._exif_queue.get()
+            batch = []
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= self._exif_batch_size:
+                    break
+                try:
+                    item = self._exif_queue.get_nowait()
+                except Empty:
+                    break
+            if batch:
+                if exif_tool is not None:
+                    self._set_durations(exif_tool, batch)
+                for e, _ in batch:
+                    self._write_queue.put(e)
+            if item is None:
+                break
+
+    def _set_durations(self, exif_tool, batch):
+        paths = [path for _, path in batch]
+        try:
+            data = exif_tool.get_tags_batch(['Duration'], paths)
+        except:
+            logger.exception(f"Error extracting the duration of {len(paths)} files")
+            return
+        durations = parse_durations(data)
+        for e, path in batch:
+            e.duration = durations.get(path)
+            e.pending_duration = False
+
+    def _write_loop(self):
+        # The end marks come from the exiftool workers, or from the last
+        # scan worker without them
+        pending_end_marks = max(self._exif_workers, 1)
+        entries = []
+        while pending_end_marks > 0:
+            e = self._write_queue.get()
+            if e is None:
+                pending_end_marks -= 1
+                continue
+            entries.append(e)
+            if len(entries) >= self._write_batch_size:
+                self._write_entries(entries)
+                entries = []
+        if entries:
+            self._write_entries(entries)
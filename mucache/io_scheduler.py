@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+import heapq
+import time
+from contextlib import contextmanager
+from enum import IntEnum
+from itertools import count
+from threading import Condition, Lock
+
+from .metrics import REGISTRY
+
+
+class IOClass(IntEnum):
+    INTERACTIVE = 0
+    ON_DEMAND = 1
+    PREFETCH = 2
+
+
+REMOTE_BYTES = REGISTRY.counter(
+    'mucache_remote_bytes_total', "Bytes read from the source files by I/O class",
+    ['io_class'])
+IO_WAIT_SECONDS = REGISTRY.histogram(
+    'mucache_io_wait_seconds', "Time waiting for a remote read slot by I/O class",
+    ['io_class'])
+IO_WAITING = REGISTRY.gauge(
+    'mucache_io_waiting', "Remote reads waiting for a slot by I/O class",
+    ['io_class'])
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self._rate = rate
+        self._burst = rate if burst is None else burst
+        self._tokens = self._burst
+        self._ts = time.monotonic()
+        self._lock = Lock()
+
+    def consume(self, n):
+        # The tokens can go negative to reserve them, so a request bigger
+        # than the burst waits its time instead of forever
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._tokens + (now - self._ts) * self._rate, self._burst)
+            self._ts = now
+            self._tokens -= n
+            wait_sec = -self._tokens / self._rate if self._tokens < 0 else 0
+        if wait_sec > 0:
+            time.sleep(wait_sec)
+
+
+class IOClassStats:
+    def __init__(self):
+        self.requests = 0
+        self.bytes = 0
+        self.waiting = 0
+        self.active = 0
+        self.wait_sec = 0.0
+        self.max_wait_sec = 0.0
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'bytes': self.bytes,
+            'waiting': self.waiting,
+            'active': self.active,
+            'wait_sec': self.wait_sec,
+            'max_wait_sec': self.max_wait_sec,
+        }
+
+
+class IOScheduler:
+    # Limit the concurrent reads of the remote files, giving the slots to
+    # the waiting requests by strict priority of its class and in arrival
+    # order inside the same class. The prefetch can be limited in bandwidth.
+    def __init__(self, max_concurrent=4, prefetch_bytes_per_sec=0):
+        self._max_concurrent = max_concurrent
+        if prefetch_bytes_per_sec > 0:
+            self._bucket = TokenBucket(prefetch_bytes_per_sec)
+        else:
+            self._bucket = None
+        self._cond = Condition()
+        self._active = 0
+        self._waiting = []
+        self._seq = count()
+        self._stats = {c: IOClassStats() for c in IOClass}
+        self._metrics = {
+            c: (REMOTE_BYTES.labels(c.name.lower()),
+                IO_WAIT_SECONDS.labels(c.name.lower()),
+                IO_WAITING.labels(c.name.lower()))
+            for c in IOClass
+        }
+
+    @contextmanager
+    def request(self, io_class, n_bytes):
+        start_ts = time.monotonic()
+        remote_bytes, wait_seconds, waiting = self._metrics[io_class]
+        waiting.inc()
+        if io_class == IOClass.PREFETCH and self._bucket is not None:
+            self._bucket.consume(n_bytes)
+
+        stats = self._stats[io_class]
+        with self._cond:
+            ticket = (io_class, next(self._seq))
+            heapq.heappush(self._waiting, ticket)
+            stats.waiting += 1
+            while self._waiting[0] != ticket or self._active >= self._max_concurrent:
+                self._cond.wait()
+            heapq.heappop(self._waiting)
+            self._active += 1
+            wait_sec = time.monotonic() - start_ts
+            stats.waiting -= 1
+            stats.active += 1
+            stats.requests += 1
+            stats.wait_sec += wait_sec
+            stats.max_wait_sec = max(stats.max_wait_sec, wait_sec)
+            # The next waiting request can also have a free slot
+            self._cond.notify_all()
+        waiting.dec()
+        wait_seconds.observe(wait_sec)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active -= 1
+                stats.active -= 1
+                stats.bytes += n_bytes
+                self._cond.notify_all()
+            remote_bytes.inc(n_bytes)
+
+    def stats(self):
+        with self._cond:
+            return {c.name.lower(): s.as_dict() for c, s in self._stats.items()}
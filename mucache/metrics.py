@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+import logging
+import os
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Lock, Thread
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    labels = ','.join(f'{k}="{v}"' for k, v in pairs)
+    return f"{{{labels}}}"
+
+
+class Metric:
+    # The metrics with labels have a child by values, the hot paths should
+    # keep the child instead of looking it up in every call
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self._label_names = tuple(label_names)
+        self._children = {}
+        self._children_lock = Lock()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._children_lock:
+                child = self._children.setdefault(values, self._create_child())
+        return child
+
+    def _create_child(self):
+        raise NotImplementedError
+
+    def _get_children(self):
+        if not self._label_names:
+            return [((), self.labels())]
+        with self._children_lock:
+            return sorted(self._children.items())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for values, child in self._get_children():
+            lines.extend(child.render(self.name, self._label_names, values))
+        return lines
+
+
+class CounterValue:
+    def __init__(self):
+        self._lock = Lock()
+        self._value = 0
+
+    def inc(self, n=1):
+        with self._lock:
+            self._value += n
+
+    def get(self):
+        return self._value
+
+    def render(self, name, label_names, values):
+        return [f"{name}{_format_labels(label_names, values)} {self._value}"]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _create_child(self):
+        return CounterValue()
+
+    def inc(self, n=1):
+        self.labels().inc(n)
+
+
+class GaugeValue(CounterValue):
+    def dec(self, n=1):
+        self.inc(-n)
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def _create_child(self):
+        return GaugeValue()
+
+    def inc(self, n=1):
+        self.labels().inc(n)
+
+    def dec(self, n=1):
+        self.labels().dec(n)
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class HistogramValue:
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self._lock = Lock()
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value):
+        i = bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def render(self, name, label_names, values):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        lines = []
+        acc = 0
+        for le, n in zip(self._buckets + (float('inf'),), counts):
+            acc += n
+            le = '+Inf' if le == float('inf') else le
+            labels = _format_labels(label_names, values, [('le', le)])
+            lines.append(f"{name}_bucket{labels} {acc}")
+        labels = _format_labels(label_names, values)
+        lines.append(f"{name}_sum{labels} {total}")
+        lines.append(f"{name}_count{labels} {acc}")
+        return lines
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, label_names=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, label_names)
+        self._buckets = tuple(sorted(buckets))
+
+    def _create_child(self):
+        return HistogramValue(self._buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+class Registry:
+    def __init__(self):
+        self._lock = Lock()
+        self._metrics = {}
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"The metric '{metric.name}' already exists")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, label_names=()):
+        return self._register(Counter(name, help, label_names))
+
+    def gauge(self, name, help, label_names=()):
+        return self._register(Gauge(name, help, label_names))
+
+    def histogram(self, name, help, label_names=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, label_names, buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class MetricsServer:
+    # Expose the metrics in the Prometheus text format
+    def __init__(self, address, registry=REGISTRY):
+        self._address = address
+        self._registry = registry
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        registry = self._registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                data = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        self._server = ThreadingHTTPServer(tuple(self._address), Handler)
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._thread = None
+
+
+class StatsFileWriter:
+    # Write periodically the metrics to a file, in the same format so it can
+    # be read by the textfile collector of the node exporter
+    def __init__(self, path, every_sec=15, registry=REGISTRY):
+        self._path = path
+        self._every_sec = every_sec
+        self._registry = registry
+        self._stopped = Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self._loop)
+        self._thread.start()
+
+    def _loop(self):
+        while not self._stopped.wait(self._every_sec):
+            self._write()
+        self._write()
+
+    def _write(self):
+        tmp_path = f"{self._path}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(self._registry.render())
+            os.replace(tmp_path, self._path)
+        except:
+            logger.exception(f"Error writing the stats file '{self._path}'")
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
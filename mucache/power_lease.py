@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+import logging
+import time
+from threading import Condition, Thread
+
+from .metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+WAKE_UPS = REGISTRY.counter(
+    'mucache_power_wake_ups_total',
+    "Number of times the power manager token was acquired")
+AVOIDED_WAKE_UPS = REGISTRY.counter(
+    'mucache_power_avoided_wake_ups_total',
+    "Number of uses of the remote that found the token still held")
+HELD = REGISTRY.gauge(
+    'mucache_power_held', "If the power manager token is held")
+
+
+class PowerLease:
+    # Share the power manager token between its users and keep it some time
+    # after the last one, so the short episodes and the bursts of events
+    # don't make the remote wake and sleep for every file. The deferrable
+    # work can wait for a window where the remote is already on.
+    def __init__(self, power_manager, linger_sec=120):
+        self._power_manager = power_manager
+        self._linger_sec = linger_sec
+
+        self._cond = Condition()
+        self._count = 0
+        self._held = False
+        self._idle_ts = 0
+        self._stopped = False
+        self._thread = None
+        self.wake_ups = 0
+        self.avoided_wake_ups = 0
+
+    def acquire(self):
+        with self._cond:
+            self._count += 1
+            if self._held:
+                if self._count == 1:
+                    self.avoided_wake_ups += 1
+                    AVOIDED_WAKE_UPS.inc()
+                return
+            # Nobody else has the token, so the other users can wait for it
+            try:
+                self._power_manager.acquire()
+            except:
+                self._count -= 1
+                raise
+            self._held = True
+            self.wake_ups += 1
+            WAKE_UPS.inc()
+            HELD.set(1)
+            self._cond.notify_all()
+
+    def release(self):
+        with self._cond:
+            self._count -= 1
+            if self._count == 0:
+                self._idle_ts = time.monotonic()
+                self._cond.notify_all()
+
+    # Return if the remote is on before the timeout
+    def wait_awake(self, timeout):
+        with self._cond:
+            return self._cond.wait_for(lambda: self._held or self._stopped, timeout)
+
+    def start(self):
+        self._thread = Thread(target=self._loop)
+        self._thread.start()
+
+    def _loop(self):
+        with self._cond:
+            while not self._stopped:
+                if self._held and self._count == 0:
+                    remaining_sec = self._idle_ts + self._linger_sec - time.monotonic()
+                    if remaining_sec <= 0:
+                        self._release()
+                    else:
+                        self._cond.wait(remaining_sec)
+                else:
+                    self._cond.wait()
+            if self._held:
+                self._release()
+
+    def _release(self):
+        logger.debug("Releasing the power manager token")
+        self._held = False
+        HELD.set(0)
+        try:
+            self._power_manager.release()
+        except:
+            logger.exception("Error releasing the power manager token")
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._thread = None
+        logger.info(f"The power manager token was acquired {self.wake_ups} times, "
+                    f"avoiding {self.avoided_wake_ups} wake-ups")
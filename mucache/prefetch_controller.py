@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+import logging
+from threading import Condition, Thread
+
+from .io_scheduler import IOClass
+
+MB = 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class PrefetchController:
+    # Keep the cached data some seconds ahead of the playhead of a file being
+    # played. The playhead is estimated from the reads, ignoring the isolated
+    # jumps of the players to read the indexes, and the needed lead grows
+    # when the source is slower than the bitrate of the file. The chunks
+    # ahead of the playhead are fetched by its own thread, so the lead
+    # doesn't depend on the prefetch workers.
+    def __init__(self, src_path, dst_path, size, duration, chunks, lead_sec=30,
+                 chunk_sizer=None, max_lead_factor=4):
+        self._src_path = src_path
+        self._dst_path = dst_path
+        self._size = size
+        self._bytes_per_sec = size / duration
+        self._chunks = chunks
+        self._lead_sec = lead_sec
+        self._chunk_sizer = chunk_sizer
+        self._max_lead_factor = max_lead_factor
+        # A read further than this from the playhead is a seek or a jump
+        self._max_jump = max(8 * MB, int(self._bytes_per_sec * 10))
+
+        self._cond = Condition()
+        self._playhead = None
+        self._jump_to = None
+        self._stopped = False
+        self._thread = None
+
+    def on_read(self, length, offset):
+        end = offset + length
+        with self._cond:
+            if self._playhead is None or self._is_near(offset, self._playhead):
+                self._playhead = max(end, self._playhead or 0)
+                self._jump_to = None
+            elif self._jump_to is not None and self._is_near(offset, self._jump_to):
+                # Two reads in the same zone, so it's a seek
+                self._playhead = end
+                self._jump_to = None
+            else:
+                self._jump_to = end
+            if self._thread is None:
+                self._thread = Thread(target=self._loop, daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _is_near(self, offset, position):
+        return position - self._max_jump <= offset <= position + self._max_jump
+
+    def _get_lead_bytes(self):
+        lead_bytes = self._lead_sec * self._bytes_per_sec
+        throughput = None
+        if self._chunk_sizer is not None:
+            throughput = self._chunk_sizer.throughput()
+        if throughput:
+            factor = self._bytes_per_sec / throughput
+            lead_bytes *= min(max(factor, 1), self._max_lead_factor)
+        return int(lead_bytes)
+
+    def is_lead_safe(self):
+        return self._playhead is not None and self._next_urgent_chunk() is None
+
+    def _next_urgent_chunk(self):
+        playhead = self._playhead
+        if playhead is None:
+            return None
+        end = min(playhead + self._get_lead_bytes(), self._size - 1)
+        bits = self._chunks.chunk_size_bits()
+        return self._chunks.first_missing_chunk(playhead >> bits, end >> bits)
+
+    def _loop(self):
+        with open(self._src_path, 'rb', buffering=0) as src_fd, \
+                open(self._dst_path, 'rb+', buffering=0) as dst_fd:
+            while True:
+                with self._cond:
+                    while not self._stopped:
+                        i = self._next_urgent_chunk()
+                        if i is not None:
+                            break
+                        self._cond.wait()
+                    if self._stopped:
+                        break
+                try:
+                    self._chunks.ensure_chunks_in_cache(
+                        src_fd, dst_fd, i, i, IOClass.ON_DEMAND)
+                except:
+                    logger.exception(f"Error fetching the chunk {i} of '{self._src_path}'")
+                    # Retry with the next read
+                    with self._cond:
+                        if not self._stopped:
+                            self._cond.wait()
+
+    def close(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+            thread = self._thread
+            self._thread = None
+        if thread is not None:
+            thread.join()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+import os
+from collections import OrderedDict
+from threading import Lock
+
+from .metrics import REGISTRY
+from .read_strategy import ReadStrategy
+
+TIER_READS = REGISTRY.counter(
+    'mucache_tier_reads_total',
+    "Number of reads of the cached files by the tier that served them",
+    ['tier'])
+TIER_READ_BYTES = REGISTRY.counter(
+    'mucache_tier_read_bytes_total',
+    "Bytes read of the cached files by the tier that served them",
+    ['tier'])
+RAM_CACHE_BYTES = REGISTRY.gauge(
+    'mucache_ram_cache_bytes', "Bytes of the chunks held in memory")
+RAM_CACHE_EVICTIONS = REGISTRY.counter(
+    'mucache_ram_cache_evictions_total', "Number of chunks evicted from memory")
+
+_RAM_READS = TIER_READS.labels('ram')
+_RAM_READ_BYTES = TIER_READ_BYTES.labels('ram')
+_DISK_READS = TIER_READS.labels('disk')
+_DISK_READ_BYTES = TIER_READ_BYTES.labels('disk')
+
+
+class RamCache:
+    # A 2Q cache: the new chunks enter a FIFO and are only promoted to the
+    # LRU when they are requested again, in the FIFO or shortly after leaving
+    # it, so the chunks read once by a playback don't flush the hot ones
+    def __init__(self, limit_in_bytes, chunk_size_bits=16, in_factor=0.25,
+                 ghost_factor=0.5):
+        self._limit_in_bytes = limit_in_bytes
+        self._chunk_size_bits = chunk_size_bits
+        self._in_limit = int(limit_in_bytes * in_factor)
+        self._ghost_limit = max(
+            int((limit_in_bytes >> chunk_size_bits) * ghost_factor), 1)
+
+        self._lock = Lock()
+        self._in = OrderedDict()
+        self._in_bytes = 0
+        # The keys recently evicted from the FIFO, without their data
+        self._ghosts = OrderedDict()
+        self._hot = OrderedDict()
+        self._hot_bytes = 0
+        self._chunks_by_id = {}
+
+    def chunk_size_bits(self):
+        return self._chunk_size_bits
+
+    # The consecutive reads of the same chunk by a client are a single
+    # request, they don't have to promote it
+    def get(self, key, promote=True):
+        with self._lock:
+            data = self._hot.get(key)
+            if data is not None:
+                self._hot.move_to_end(key)
+                return data
+            if not promote:
+                return self._in.get(key)
+            data = self._in.pop(key, None)
+            if data is not None:
+                self._in_bytes -= len(data)
+                self._hot[key] = data
+                self._hot_bytes += len(data)
+            return data
+
+    def put(self, key, data):
+        with self._lock:
+            if key in self._hot or key in self._in:
+                return
+            if self._ghosts.pop(key, None) is not None:
+                self._hot[key] = data
+                self._hot_bytes += len(data)
+            else:
+                self._in[key] = data
+                self._in_bytes += len(data)
+            self._chunks_by_id.setdefault(key[0], set()).add(key[1])
+            self._evict()
+            RAM_CACHE_BYTES.set(self._in_bytes + self._hot_bytes)
+
+    def _evict(self):
+        while self._in_bytes + self._hot_bytes > self._limit_in_bytes:
+            if self._in and (self._in_bytes > self._in_limit or not self._hot):
+                key, data = self._in.popitem(last=False)
+                self._in_bytes -= len(data)
+                self._ghosts[key] = True
+                if len(self._ghosts) > self._ghost_limit:
+                    self._ghosts.popitem(last=False)
+            else:
+                key, data = self._hot.popitem(last=False)
+                self._hot_bytes -= len(data)
+            self._discard_index(key)
+            RAM_CACHE_EVICTIONS.inc()
+
+    def _discard_index(self, key):
+        chunks = self._chunks_by_id.get(key[0])
+        if chunks is not None:
+            chunks.discard(key[1])
+            if not chunks:
+                del self._chunks_by_id[key[0]]
+
+    def invalidate(self, id):
+        with self._lock:
+            for i in self._chunks_by_id.pop(id, ()):
+                key = (id, i)
+                data = self._in.pop(key, None)
+                if data is not None:
+                    self._in_bytes -= len(data)
+                data = self._hot.pop(key, None)
+                if data is not None:
+                    self._hot_bytes -= len(data)
+            # A file cached again under the same id starts without history
+            for key in [key for key in self._ghosts if key[0] == id]:
+                del self._ghosts[key]
+            RAM_CACHE_BYTES.set(self._in_bytes + self._hot_bytes)
+
+
+class RamCacheReadStrategy(ReadStrategy):
+    # Read the cached files by whole chunks through the RAM cache, the cache
+    # directory is the second tier
+    def __init__(self, fd, id, size, ram_cache):
+        self._fd = fd
+        self._id = id
+        self._size = size
+        self._ram_cache = ram_cache
+        self._chunk_size_bits = ram_cache.chunk_size_bits()
+        self._last_key = None
+
+    def read(self, length, offset):
+        end = min(offset + length, self._size)
+        if offset >= end:
+            return b''
+        a = offset >> self._chunk_size_bits
+        b = (end - 1) >> self._chunk_size_bits
+        parts = []
+        from_disk = False
+        for i in range(a, b + 1):
+            key = (self._id, i)
+            data = self._ram_cache.get(key, promote=key != self._last_key)
+            self._last_key = key
+            if data is None:
+                from_disk = True
+                data = os.pread(self._fd.fileno(), 1 << self._chunk_size_bits,
+                                i << self._chunk_size_bits)
+                self._ram_cache.put(key, data)
+            parts.append(data)
+        start = offset - (a << self._chunk_size_bits)
+        data = parts[0] if len(parts) == 1 else b''.join(parts)
+        data = data[start:start + end - offset]
+        if from_disk:
+            _DISK_READS.inc()
+            _DISK_READ_BYTES.inc(len(data))
+        else:
+            _RAM_READS.inc()
+            _RAM_READ_BYTES.inc(len(data))
+        return data
+
+    def cache_next_chunk(self):
+        return False
+
+    def close(self):
+        self._fd.close()
+        self._fd = None
+        return True
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+import logging
+from threading import Condition, Thread
+
+logger = logging.getLogger(__name__)
+
+
+class ReadAhead:
+    def __init__(self, src_path, dst_path, chunks, min_window=2, max_window=32):
+        self._src_path = src_path
+        self._dst_path = dst_path
+        self._chunks = chunks
+        self._min_window = min_window
+        self._max_window = max(min_window, max_window)
+
+        self._last_chunk = None
+        self._window = 0
+        self._window_end = 0
+
+        self._cond = Condition()
+        self._next = 0
+        self._end = 0
+        self._stopped = False
+        self._thread = None
+
+    def on_read(self, length, offset):
+        bits = self._chunks.chunk_size_bits()
+        first = offset >> bits
+        last = (offset + max(length, 1) - 1) >> bits
+        sequential = self._last_chunk is not None \
+            and self._last_chunk <= first <= self._last_chunk + 1
+        self._last_chunk = last
+
+        if not sequential:
+            if self._window > 0:
+                self._window = 0
+                self._request(0, 0)
+            return
+
+        # Like the kernel readahead, start with a small window and double
+        # it each time the reader consumes half of the last window
+        if self._window == 0:
+            self._window = self._min_window
+            self._window_end = last + 1
+        elif last + (self._window >> 1) < self._window_end:
+            return
+        else:
+            self._window = min(self._window << 1, self._max_window)
+
+        start = max(self._window_end, last + 1)
+        self._window_end = min(start + self._window, self._chunks.num_chunks())
+        if start < self._window_end:
+            self._request(start, self._window_end)
+
+    def _request(self, start, end):
+        with self._cond:
+            self._next = start
+            self._end = end
+            if self._thread is None and start < end:
+                self._thread = Thread(target=self._loop, daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _loop(self):
+        with open(self._src_path, 'rb', buffering=0) as src_fd, \
+                open(self._dst_path, 'rb+', buffering=0) as dst_fd:
+            while True:
+                with self._cond:
+                    while not self._stopped and self._next >= self._end:
+                        self._cond.wait()
+                    if self._stopped:
+                        break
+                    i = self._next
+                    self._next += 1
+                try:
+                    self._chunks.ensure_chunks_in_cache(src_fd, dst_fd, i, i)
+                except:
+                    logger.exception(f"Error reading ahead the chunk {i} of '{self._src_path}'")
+                    with self._cond:
+                        self._end = self._next
+
+    def close(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+            thread = self._thread
+            self._thread = None
+        if thread is not None:
+            thread.join()
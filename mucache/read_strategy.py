@@ -1,4 +1,23 @@
 #!/usr/bin/env python3
+import os
+
+from .io_scheduler import IOClass
+from .metrics import REGISTRY
+
+READS = REGISTRY.counter(
+    'mucache_reads_total',
+    "Number of reads by state of the file and if they were served from the cache",
+    ['state', 'result'])
+READ_BYTES = REGISTRY.counter(
+    'mucache_read_bytes_total',
+    "Bytes read by state of the file and if they were served from the cache",
+    ['state', 'result'])
+
+_CACHING_HITS = READS.labels('caching', 'hit')
+_CACHING_HIT_BYTES = READ_BYTES.labels('caching', 'hit')
+_CACHING_MISSES = READS.labels('caching', 'miss')
+_CACHING_MISS_BYTES = READ_BYTES.labels('caching', 'miss')
+
 
 class ReadStrategy:
     def read(self, length, offset):
@@ -12,12 +31,16 @@ class ReadStrategy:
 
 
 class DirectReadStrategy(ReadStrategy):
-    def __init__(self, fd):
+    def __init__(self, fd, io_scheduler=None):
         self._fd = fd
+        # Only the reads of the remote files go through the scheduler
+        self._io_scheduler = io_scheduler
 
     def read(self, length, offset):
-        self._fd.seek(offset)
-        return self._fd.read(length)
+        if self._io_scheduler is None:
+            return os.pread(self._fd.fileno(), length, offset)
+        with self._io_scheduler.request(IOClass.INTERACTIVE, length):
+            return os.pread(self._fd.fileno(), length, offset)
 
     def cache_next_chunk(self):
         return False
@@ -28,16 +51,57 @@ class DirectReadStrategy(ReadStrategy):
         return True
 
 
+class LazyReadStrategy(ReadStrategy):
+    # Open the strategy with the first read that needs it
+    def __init__(self, open_strategy):
+        self._open_strategy = open_strategy
+        self._strategy = None
+
+    def read(self, length, offset):
+        if self._strategy is None:
+            self._strategy = self._open_strategy()
+        return self._strategy.read(length, offset)
+
+    def cache_next_chunk(self):
+        return False
+
+    def close(self):
+        if self._strategy is not None:
+            self._strategy.close()
+            self._strategy = None
+        return True
+
+
 class CacheReadStrategy(ReadStrategy):
-    def __init__(self, src_fd, dst_fd, chunks):
+    def __init__(self, src_fd, dst_fd, chunks, read_ahead=None,
+                 prefetch_controller=None):
         self._src_fd = src_fd
         self._dst_fd = dst_fd
         self._chunks = chunks
+        self._read_ahead = read_ahead
+        self._prefetch_controller = prefetch_controller
 
     def read(self, length, offset):
-        self._chunks.ensure_in_cache(self._src_fd, self._dst_fd, length, offset)
-        self._dst_fd.seek(offset)
-        return self._dst_fd.read(length)
+        if self._read_ahead is not None:
+            self._read_ahead.on_read(length, offset)
+        if self._prefetch_controller is not None:
+            self._prefetch_controller.on_read(length, offset)
+        missed = self._chunks.ensure_in_cache(
+            self._src_fd, self._dst_fd, length, offset)
+        data = os.pread(self._dst_fd.fileno(), length, offset)
+        if missed:
+            _CACHING_MISSES.inc()
+            _CACHING_MISS_BYTES.inc(len(data))
+        else:
+            _CACHING_HITS.inc()
+            _CACHING_HIT_BYTES.inc(len(data))
+        return data
+
+    # If the file is being played with enough data cached ahead, so the
+    # prefetch of other files can go first
+    def is_lead_safe(self):
+        return self._prefetch_controller is not None \
+            and self._prefetch_controller.is_lead_safe()
 
     def cache_next_chunk(self):
         return self._chunks.cache_next_chunk(
@@ -46,6 +110,13 @@ class CacheReadStrategy(ReadStrategy):
         )
 
     def close(self):
+        if self._read_ahead is not None:
+            self._read_ahead.close()
+            self._read_ahead = None
+        if self._prefetch_controller is not None:
+            self._prefetch_controller.close()
+            self._prefetch_controller = None
+        self._chunks.close(self._dst_fd)
         self._src_fd.close()
         self._src_fd = None
         self._dst_fd.close()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+import logging
+import os
+import os.path
+import shutil
+import stat
+import tempfile
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from itertools import product
+from threading import Lock
+
+from .cleaner import EVICTIONS, Cleaner
+from .eviction import POLICIES
+from .filesystem import Filesystem
+from .io_scheduler import IOScheduler
+from .read_strategy import READ_BYTES
+from .storage import SqliteWrapper, Storage
+from .trace import OPEN, READ, RELEASE, read_trace
+from .types import ST_KEYS, State
+
+logger = logging.getLogger(__name__)
+
+MIB = 1024 * 1024
+GIB = 1024 * 1024 * 1024
+
+
+def create_arg_parser():
+    p = ArgumentParser(
+        description="Replay a trace of accesses with a simulated clock and "
+        "storage to compare the cache parameters.",
+        prog="python -m mucache replay",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    p.add_argument('trace', help='trace recorded with --trace-file')
+    p.add_argument('db_path', help='copy of the DB of the traced files')
+    p.add_argument('--cache-limit', default=[180], type=int, nargs='+',
+                   help='cache limits to simulate in gibibytes')
+    p.add_argument('--prefetch-min', default=[180], type=int, nargs='+',
+                   help='maximum numbers of minutes to prefetch')
+    p.add_argument('--prefetch-gib', default=[10], type=int, nargs='+',
+                   help='maximum numbers of gibibytes to prefetch')
+    p.add_argument('--passthrough-mib', default=None, type=int, nargs='+',
+                   help='mebibytes read from a file before caching it, by '
+                   'default 15%% of its size between 16 and 64 MiB')
+    p.add_argument('--eviction-policy', default=['lru'], choices=sorted(POLICIES),
+                   nargs='+', help='policies to choose the files to evict')
+    p.add_argument('--pm-sleep-min', default=15, type=int,
+                   help='minutes without use before the remote is turned off')
+    p.add_argument('--log-level', default='WARNING',
+                   choices=('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'),
+                   help='logger level')
+    return p
+
+
+class SimClock:
+    def __init__(self, ts=0):
+        self._ts = ts
+
+    def time(self):
+        return self._ts
+
+    def set(self, ts):
+        self._ts = max(self._ts, ts)
+
+
+class SimPowerManager:
+    def __init__(self, clock, sleep_after_sec):
+        self._clock = clock
+        self._sleep_after_sec = sleep_after_sec
+        self._lock = Lock()
+        self._count = 0
+        self._released_ts = None
+        self.wake_ups = 0
+
+    def acquire(self):
+        with self._lock:
+            self._count += 1
+            if self._count == 1 and (self._released_ts is None or
+                    self._clock.time() - self._released_ts > self._sleep_after_sec):
+                self.wake_ups += 1
+
+    def release(self):
+        with self._lock:
+            self._count -= 1
+            if self._count == 0:
+                self._released_ts = self._clock.time()
+
+
+class NullCopier:
+    # The copies are instantaneous, the source and cache files are sparse
+    def copy(self, src_fd, dst_fd, offset, size):
+        return size
+
+
+def create_sparse_files(storage, paths, src_path):
+    # Only the files near the traced ones can be prefetched
+    prefixes = set()
+    for path in paths:
+        parent = os.path.dirname(path)
+        grandparent = os.path.dirname(parent)
+        prefixes.add((parent if grandparent == '/' else grandparent).rstrip('/') + '/')
+    prefixes = tuple(prefixes)
+
+    st_mode_index = ST_KEYS.index('st_mode')
+    st_size_index = ST_KEYS.index('st_size')
+    for _, _, path, _, *attrs in storage.get_tree_entries():
+        if not path.startswith(prefixes) \
+                or not stat.S_ISREG(attrs[st_mode_index] or 0):
+            continue
+        full_path = os.path.join(src_path, path[1:])
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'wb') as f:
+            f.truncate(attrs[st_size_index] or 0)
+
+
+def get_read_bytes():
+    res = {}
+    for state in ('no_cached', 'caching', 'cached'):
+        for result in ('hit', 'miss'):
+            res[result] = res.get(result, 0) + READ_BYTES.labels(state, result).get()
+    return res
+
+
+def replay(events, src_path, args, params):
+    cache_limit, prefetch_min, prefetch_gib, passthrough_mib, policy = params
+    tmp_path = tempfile.mkdtemp(prefix='mucache-replay-')
+    cache_path = os.path.join(tmp_path, 'cache')
+    os.mkdir(cache_path)
+    db_path = os.path.join(tmp_path, 'db.sqlite')
+    shutil.copy(args.db_path, db_path)
+
+    storage = Storage(SqliteWrapper(db_path))
+    storage.setup()
+    storage.set_states(State.CACHING, State.NO_CACHED)
+    storage.set_states(State.CACHED, State.NO_CACHED)
+
+    clock = SimClock(events[0][1] if events else 0)
+    try:
+        power_manager = SimPowerManager(clock, args.pm_sleep_min * 60)
+        io_scheduler = IOScheduler(max_concurrent=64)
+        cleaner = Cleaner(cache_path, storage, cache_limit * GIB,
+                          eviction_policy=policy)
+        fs = Filesystem(
+            src_path=src_path,
+            dst_path=cache_path,
+            storage=storage,
+            power_manager=power_manager,
+            cleaner=cleaner,
+            prefetch_sec=prefetch_min * 60,
+            prefetch_bytes=prefetch_gib * GIB,
+            io_scheduler=io_scheduler,
+            passthrough_bytes=None if passthrough_mib is None else passthrough_mib * MIB,
+            copier=NullCopier(),
+            clock=clock.time,
+        )
+        read_bytes = get_read_bytes()
+        evictions = EVICTIONS.labels().get()
+        cleaner.start()
+        fs.start()
+        try:
+            replay_events(fs, cleaner, clock, events)
+        finally:
+            fs.stop()
+            cleaner.stop()
+    finally:
+        shutil.rmtree(tmp_path)
+
+    hit_bytes = get_read_bytes()['hit'] - read_bytes['hit']
+    miss_bytes = get_read_bytes()['miss'] - read_bytes['miss']
+    remote_bytes = sum(s['bytes'] for s in io_scheduler.stats().values())
+    return {
+        'hit_ratio': hit_bytes / max(hit_bytes + miss_bytes, 1),
+        'remote_bytes': remote_bytes,
+        'wake_ups': power_manager.wake_ups,
+        'evictions': EVICTIONS.labels().get() - evictions,
+    }
+
+
+def replay_events(fs, cleaner, clock, events):
+    opened = {}
+    for type, ts, fh, path, offset, length in events:
+        # The background work ends before the time advances
+        fs.wait_idle()
+        cleaner.wait_idle()
+        clock.set(ts)
+        if type == OPEN:
+            sim_fh = fs.open(path)
+            if sim_fh is not None:
+                opened.setdefault(fh, []).append((path, sim_fh))
+        elif type == READ:
+            files = opened.get(fh)
+            if files:
+                path, sim_fh = files[-1]
+                fs.read(path, sim_fh, length, offset)
+        elif type == RELEASE:
+            files = opened.get(fh)
+            if files:
+                _, sim_fh = files.pop()
+                fs.close(sim_fh)
+    for files in opened.values():
+        for _, sim_fh in files:
+            fs.close(sim_fh)
+    fs.wait_idle()
+    cleaner.wait_idle()
+
+
+def main(argv=None):
+    args = create_arg_parser().parse_args(argv)
+    logging.basicConfig(level=args.log_level)
+
+    events = list(read_trace(args.trace))
+    paths = {path for type, _, _, path, _, _ in events if type == OPEN}
+    src_path = tempfile.mkdtemp(prefix='mucache-replay-src-')
+    try:
+        storage = Storage(SqliteWrapper(args.db_path))
+        create_sparse_files(storage, paths, src_path)
+
+        print(f"{'cache GiB':>9} {'pf min':>6} {'pf GiB':>6} {'pt MiB':>6} "
+              f"{'policy':<6} {'hit ratio':>9} {'remote GiB':>10} "
+              f"{'wake-ups':>8} {'evictions':>9}")
+        all_params = product(args.cache_limit, args.prefetch_min, args.prefetch_gib,
+                             args.passthrough_mib or [None], args.eviction_policy)
+        for params in all_params:
+            res = replay(events, src_path, args, params)
+            cache_limit, prefetch_min, prefetch_gib, passthrough_mib, policy = params
+            passthrough = '-' if passthrough_mib is None else passthrough_mib
+            print(f"{cache_limit:>9} {prefetch_min:>6} {prefetch_gib:>6} "
+                  f"{passthrough:>6} {policy:<6} {res['hit_ratio']:>9.3f} "
+                  f"{res['remote_bytes'] / GIB:>10.2f} {res['wake_ups']:>8} "
+                  f"{res['evictions']:>9}")
+    finally:
+        shutil.rmtree(src_path)
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+import logging
+import os
+import os.path
+import shutil
+import stat
+import struct
+import time
+from queue import Empty, Queue
+from threading import Event, Lock, Thread
+
+from .io_scheduler import IOClass
+from .types import ST_KEYS
+
+SEGMENTS_DIR = 'segments'
+
+MEDIA_EXTENSIONS = {
+    '.avi', '.flac', '.m2ts', '.m4a', '.m4v', '.mkv', '.mov', '.mp3', '.mp4',
+    '.mpeg', '.mpg', '.ogg', '.ogm', '.ts', '.webm', '.wmv',
+}
+
+logger = logging.getLogger(__name__)
+
+
+def is_media_path(path):
+    return os.path.splitext(path)[1].lower() in MEDIA_EXTENSIONS
+
+
+class Segment:
+    # The first and last bytes of a file, that the players read to probe it
+    # before starting the playback
+    def __init__(self, path, size, head_size, tail_size, data_offset):
+        self._path = path
+        self._size = size
+        self._head_size = head_size
+        self._tail_size = tail_size
+        self._data_offset = data_offset
+
+    def contains(self, length, offset):
+        end = min(offset + length, self._size)
+        return end <= self._head_size or offset >= self._size - self._tail_size
+
+    def read(self, length, offset):
+        end = min(offset + length, self._size)
+        if offset >= end:
+            return b''
+        if end <= self._head_size:
+            pos = offset
+        else:
+            pos = self._head_size + offset - (self._size - self._tail_size)
+        fd = os.open(self._path, os.O_RDONLY)
+        try:
+            return os.pread(fd, end - offset, self._data_offset + pos)
+        finally:
+            os.close(fd)
+
+
+class SegmentStore:
+    # Every file has the file size and the sizes of the head and tail
+    # followed by both segments, so a file that changed of size isn't used.
+    # The segments aren't evicted, so the pinning stops at the limit.
+    _HEADER = struct.Struct('<QQQ')
+
+    def __init__(self, cache_path, head_bytes, tail_bytes, limit_in_bytes=0):
+        self._path = os.path.join(cache_path, SEGMENTS_DIR)
+        self._head_bytes = head_bytes
+        self._tail_bytes = tail_bytes
+        self._limit_in_bytes = limit_in_bytes
+        self._lock = Lock()
+        self._bytes = 0
+        os.makedirs(self._path, exist_ok=True)
+
+    def _get_path(self, id):
+        return os.path.join(self._path, str(id))
+
+    def bytes(self):
+        return self._bytes
+
+    # Return the ids with segments, and count their bytes
+    def scan(self):
+        ids = set()
+        n_bytes = 0
+        with os.scandir(self._path) as it:
+            for entry in it:
+                try:
+                    ids.add(int(entry.name))
+                except ValueError:
+                    # The temporary files of an interrupted pinning
+                    os.remove(entry.path)
+                    continue
+                n_bytes += entry.stat().st_size
+        with self._lock:
+            self._bytes = n_bytes
+        return ids
+
+    def load(self, id, size):
+        path = self._get_path(id)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read(self._HEADER.size)
+        except FileNotFoundError:
+            return None
+        if len(data) < self._HEADER.size:
+            return None
+        file_size, head_size, tail_size = self._HEADER.unpack(data)
+        if file_size != size:
+            return None
+        return Segment(path, size, head_size, tail_size, self._HEADER.size)
+
+    def has(self, id, size):
+        return self.load(id, size) is not None
+
+    def get_sizes(self, size):
+        head_size = min(self._head_bytes, size)
+        tail_size = min(self._tail_bytes, size - head_size)
+        return (head_size, tail_size)
+
+    def has_space(self, size):
+        n_bytes = self._HEADER.size + sum(self.get_sizes(size))
+        return self._limit_in_bytes <= 0 \
+            or self._bytes + n_bytes <= self._limit_in_bytes
+
+    def put(self, id, size, head, tail):
+        n_bytes = self._HEADER.size + len(head) + len(tail)
+        with self._lock:
+            self._bytes += n_bytes
+
+        path = self._get_path(id)
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(self._HEADER.pack(size, len(head), len(tail)))
+                f.write(head)
+                f.write(tail)
+            self.remove(id)
+            os.replace(tmp_path, path)
+        except:
+            with self._lock:
+                self._bytes -= n_bytes
+            raise
+
+    def remove(self, id):
+        try:
+            n_bytes = os.path.getsize(self._get_path(id))
+            os.remove(self._get_path(id))
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self._bytes -= n_bytes
+
+    def clear(self):
+        shutil.rmtree(self._path, ignore_errors=True)
+        os.makedirs(self._path, exist_ok=True)
+        with self._lock:
+            self._bytes = 0
+
+
+class SegmentPinner:
+    # Pin in background the segments of the indexed media files, in batches
+    # with the power manager token held
+    def __init__(self, src_path, store, storage, power_manager,
+                 io_scheduler=None, batch_size=64, batch_wait_sec=2):
+        self._src_path = src_path
+        self._store = store
+        self._storage = storage
+        self._power_manager = power_manager
+        self._io_scheduler = io_scheduler
+        self._batch_size = batch_size
+        self._batch_wait_sec = batch_wait_sec
+
+        self._thread = None
+        self._loop_queue = Queue()
+        self._stopped = Event()
+
+    def add(self, id, relpath, size):
+        self._loop_queue.put((id, relpath, size))
+
+    # The entries are new or changed, the segments of a changed file can
+    # be stale even with the same size
+    def add_entries(self, entries):
+        for e in entries:
+            if stat.S_ISREG(e.st_mode):
+                self._store.remove(e.id)
+                if is_media_path(e.path):
+                    self.add(e.id, e.path, e.st_size)
+
+    def remove(self, id):
+        self._store.remove(id)
+
+    def clear(self):
+        self._store.clear()
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = Thread(target=self._loop)
+        self._thread.start()
+
+    def _add_missing(self):
+        # Pin the files indexed before enabling the pinning
+        pinned_ids = self._store.scan()
+        mode_index = ST_KEYS.index('st_mode')
+        size_index = ST_KEYS.index('st_size')
+        for id, _, path, _, *attrs in self._storage.get_tree_entries():
+            st_mode, size = attrs[mode_index], attrs[size_index]
+            if id not in pinned_ids and st_mode is not None \
+                    and stat.S_ISREG(st_mode) and is_media_path(path):
+                self.add(id, path, size)
+
+    def _loop(self):
+        try:
+            self._add_missing()
+        except:
+            logger.exception("Error looking for the files without segments")
+        while not self._stopped.is_set():
+            item = self._loop_queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self._batch_wait_sec
+            while len(batch) < self._batch_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self._loop_queue.get(timeout=max(timeout, 0))
+                except Empty:
+                    break
+                if item is None:
+                    self._stopped.set()
+                    break
+                batch.append(item)
+            self._pin(batch)
+
+    def _pin(self, batch):
+        batch = [(id, relpath, size) for id, relpath, size in batch
+                 if not self._store.has(id, size)]
+        if not batch:
+            return
+        logger.debug(f"Pinning the segments of {len(batch)} files")
+        skipped = 0
+        self._power_manager.acquire()
+        try:
+            for id, relpath, size in batch:
+                if self._stopped.is_set():
+                    break
+                if not self._store.has_space(size):
+                    skipped += 1
+                    continue
+                src_path = os.path.join(self._src_path, relpath[1:])
+                try:
+                    head, tail = self._read_segments(src_path, size)
+                    self._store.put(id, size, head, tail)
+                except:
+                    logger.exception(f"Error pinning the segments of '{relpath}'")
+        finally:
+            self._power_manager.release()
+        if skipped > 0:
+            logger.warning(f"The segments reached their limit, {skipped} files weren't pinned")
+
+    def _read_segments(self, src_path, size):
+        head_size, tail_size = self._store.get_sizes(size)
+        with open(src_path, 'rb', buffering=0) as f:
+            if self._io_scheduler is None:
+                head = os.pread(f.fileno(), head_size, 0)
+                tail = os.pread(f.fileno(), tail_size, size - tail_size)
+            else:
+                with self._io_scheduler.request(IOClass.PREFETCH, head_size + tail_size):
+                    head = os.pread(f.fileno(), head_size, 0)
+                    tail = os.pread(f.fileno(), tail_size, size - tail_size)
+        if len(head) != head_size or len(tail) != tail_size:
+            raise IOError(f"The file '{src_path}' is smaller than {size} bytes")
+        return (head, tail)
+
+    def stop(self):
+        self._stopped.set()
+        self._loop_queue.put(None)
+        self._thread.join()
+        self._thread = None
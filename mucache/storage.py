@@ -2,10 +2,16 @@
 import dataclasses
 import sqlite3
 import stat
-from threading import Lock
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Condition, Lock
 
 from .types import ST_KEYS, Entry, State
 
+# Bytes per second used to estimate the duration of the files that don't
+# have it yet
+ESTIMATED_BYTES_PER_SEC = 1024 * 1024
+
 
 class SqliteWrapper:
     def __init__(self, path):
@@ -43,11 +49,93 @@ class SqliteWrapper:
             with self._db:
                 self._db.executemany(query, seq_of_parameters)
 
+    def write_batch(self, queries):
+        with self._lock:
+            with self._db:
+                for query, seq_of_parameters in queries:
+                    self._db.executemany(query, seq_of_parameters)
+
     def close(self):
         with self._lock:
             self._db.close()
 
 
+class SqlitePoolWrapper:
+    def __init__(self, path, max_readers=4):
+        self._path = path
+        self._max_readers = max_readers
+        self._writer = sqlite3.connect(path, check_same_thread=False)
+        self._writer.execute('PRAGMA journal_mode=WAL')
+        self._writer.execute('PRAGMA synchronous=NORMAL')
+        self._writer_lock = Lock()
+        self._readers_cond = Condition()
+        self._idle_readers = []
+        self._readers = []
+
+    def _connect_reader(self):
+        uri = f"{Path(self._path).resolve().as_uri()}?mode=ro"
+        return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+    @contextmanager
+    def _reader(self):
+        with self._readers_cond:
+            while not self._idle_readers and len(self._readers) >= self._max_readers:
+                self._readers_cond.wait()
+            if self._idle_readers:
+                db = self._idle_readers.pop()
+            else:
+                db = self._connect_reader()
+                self._readers.append(db)
+        try:
+            yield db
+        finally:
+            with self._readers_cond:
+                self._idle_readers.append(db)
+                self._readers_cond.notify()
+
+    def read_one(self, query, args=None):
+        with self._reader() as db:
+            c = db.execute(query) if args is None else db.execute(query, args)
+            r = c.fetchone()
+            c.close()
+            return r
+
+    def read_all(self, query, args=None):
+        with self._reader() as db:
+            c = db.execute(query) if args is None else db.execute(query, args)
+            r = c.fetchall()
+            c.close()
+            return r
+
+    def write(self, query, args=None):
+        with self._writer_lock:
+            with self._writer:
+                if args is None:
+                    self._writer.execute(query)
+                else:
+                    self._writer.execute(query, args)
+
+    def write_many(self, query, seq_of_parameters):
+        with self._writer_lock:
+            with self._writer:
+                self._writer.executemany(query, seq_of_parameters)
+
+    def write_batch(self, queries):
+        with self._writer_lock:
+            with self._writer:
+                for query, seq_of_parameters in queries:
+                    self._writer.executemany(query, seq_of_parameters)
+
+    def close(self):
+        with self._readers_cond:
+            for db in self._readers:
+                db.close()
+            self._readers.clear()
+            self._idle_readers.clear()
+        with self._writer_lock:
+            self._writer.close()
+
+
 class Storage:
     def __init__(self, db):
         self._db = db
@@ -55,6 +143,17 @@ class Storage:
     def setup(self):
         for q in self._get_create_tables():
             self._db.write(q)
+        self._migrate()
+
+    def _migrate(self):
+        columns = {x[1] for x in self._db.read_all('PRAGMA table_info(filesystem)')}
+        for name, definition in self._get_added_columns():
+            if name not in columns:
+                self._db.write(f'ALTER TABLE filesystem ADD COLUMN {name} {definition}')
+
+    def _get_added_columns(self):
+        yield ('access_count', 'INTEGER NOT NULL DEFAULT 0')
+        yield ('pending_duration', 'INTEGER NOT NULL DEFAULT 0')
 
     def _get_create_tables(self):
         yield '''CREATE TABLE IF NOT EXISTS filesystem (
@@ -64,7 +163,9 @@ class Storage:
             name TEXT NOT NULL,
             state INTEGER NOT NULL DEFAULT 0, -- Enum: 0 = no cached, 1 = caching, 2 = cached
             last_access_ts INTEGER,
+            access_count INTEGER NOT NULL DEFAULT 0,
             duration INTEGER, -- The duration of the video files, it is null in other case
+            pending_duration INTEGER NOT NULL DEFAULT 0, -- If the duration isn't extracted yet
             st_mode INTEGER,
             st_ino INTEGER,
             st_dev INTEGER,
@@ -113,19 +214,15 @@ class Storage:
             return (None, None, None)
         return (res[0], State(res[1]), res[2])
 
-    def get_state_size(self, id):
-        query = "SELECT state, st_size FROM filesystem WHERE id = ?"
-        res = self._db.read_one(query, (id,))
-        if res is None:
-            return (None, None)
-        return (res[0], res[1])
-
-    def get_children_names(self, parent_id):
-        query = "SELECT name FROM filesystem WHERE parent_id = ?"
+    def get_children_attrs(self, parent_id):
+        query = (f"SELECT name, path, {','.join(ST_KEYS)} "
+                 "FROM filesystem "
+                 "WHERE parent_id = ? "
+                 "ORDER BY name")
         res = self._db.read_all(query, (parent_id,))
         if res is None:
             return None
-        return [x for x, in res]
+        return [(name, path, dict(zip(ST_KEYS, attrs))) for name, path, *attrs in res]
 
     def get_children_ids(self, parent_id):
         query = "SELECT id FROM filesystem WHERE parent_id = ?"
@@ -134,20 +231,33 @@ class Storage:
             return None
         return [x for x, in res]
 
+    def get_tree_entries(self):
+        query = f"SELECT id, parent_id, path, name, {','.join(ST_KEYS)} FROM filesystem"
+        return self._db.read_all(query) or []
+
     def get_next_files_to_cache(self, path, max_duration, max_size):
-        query = ("SELECT id, path, state, duration, st_size "
+        query = ("SELECT id, path, state, duration, pending_duration, st_size "
                  "FROM filesystem "
                  "WHERE path >= ? "
                  "ORDER BY path "
                  "LIMIT 50")
         rows = self._db.read_all(query, (path,))
 
+        # Estimate the pending durations with the bitrate of the near files
+        known = [(d, s) for _, _, _, d, _, s in rows if d]
+        if known:
+            bytes_per_sec = sum(s for _, s in known) / sum(d for d, _ in known)
+        else:
+            bytes_per_sec = ESTIMATED_BYTES_PER_SEC
+
         res = []
         acc_duration = 0
         acc_size = 0
-        for id, path, state, duration, size in rows:
+        for id, path, state, duration, pending_duration, size in rows:
             if duration is None:
-                continue
+                if not pending_duration:
+                    continue
+                duration = size / bytes_per_sec
             acc_duration += duration
             acc_size += size
             if res and ((acc_duration > max_duration) or (acc_size > max_size)):
@@ -156,6 +266,14 @@ class Storage:
                 res.append((id, path, size))
         return res
 
+    def get_pending_durations(self):
+        query = "SELECT id, path FROM filesystem WHERE pending_duration = 1"
+        return self._db.read_all(query) or []
+
+    def set_durations(self, durations):
+        query = "UPDATE filesystem SET duration = ?, pending_duration = 0 WHERE id = ?"
+        self._db.write_many(query, [(duration, id) for id, duration in durations])
+
     def get_next_file_path_state(self, path):
         query = ("SELECT path, state, st_mode "
                  "FROM filesystem "
@@ -180,30 +298,61 @@ class Storage:
         query = "UPDATE filesystem SET last_access_ts = ? WHERE id = ?"
         self._db.write(query, (ts, id))
 
-    def get_cached_bytes(self):
-        query = ("SELECT sum(st_size) "
-                 "FROM filesystem "
-                 "WHERE state = ?")
-        return self._db.read_one(query, (State.CACHED,))[0] or 0
+    def touch(self, id, ts):
+        query = ("UPDATE filesystem "
+                 "SET last_access_ts = ?, access_count = access_count + 1 "
+                 "WHERE id = ?")
+        self._db.write(query, (ts, id))
 
-    def get_oldest_cached_files(self, limit=50):
-        query = ("SELECT id, st_size "
-                 "FROM filesystem "
-                 "WHERE state = ? "
-                 "ORDER BY last_access_ts "
-                 "LIMIT ?")
-        res = self._db.read_all(query, (State.CACHED, limit))
-        return (len(res) == limit, res)
-
-    def get_cached_ids(self):
-        query = "SELECT id FROM filesystem WHERE state = ?"
-        res = self._db.read_all(query, (State.CACHED,))
+    def update_accesses_and_states(self, last_access_ts, access_counts, states):
+        self._db.write_batch([
+            ("UPDATE filesystem SET last_access_ts = ? WHERE id = ?",
+             [(ts, id) for id, ts in last_access_ts]),
+            ("UPDATE filesystem SET access_count = access_count + ? WHERE id = ?",
+             [(n, id) for id, n in access_counts]),
+            ("UPDATE filesystem SET state = ? WHERE id = ? and state = ?",
+             [(new_state, id, old_state) for id, old_state, new_state in states]),
+        ])
+
+    def get_access_count(self, id):
+        query = "SELECT access_count FROM filesystem WHERE id = ?"
+        res = self._db.read_one(query, (id,))
+        if res is None:
+            return 0
+        return res[0]
+
+    def get_duration(self, id):
+        query = "SELECT duration FROM filesystem WHERE id = ?"
+        res = self._db.read_one(query, (id,))
+        if res is None:
+            return None
+        return res[0]
+
+    def get_state_paths(self, state):
+        query = "SELECT path FROM filesystem WHERE state = ? ORDER BY path"
+        res = self._db.read_all(query, (state,))
         return [x for x, in (res or [])]
 
+    def get_cache_entries(self):
+        query = ("SELECT id, state, last_access_ts, access_count, st_size "
+                 "FROM filesystem "
+                 "WHERE state != ?")
+        return self._db.read_all(query, (State.NO_CACHED,)) or []
+
+    def get_sync_entries(self):
+        query = ("SELECT path, id, parent_id, st_mode, st_size, st_mtime, "
+                 "last_access_ts, access_count "
+                 "FROM filesystem")
+        return self._db.read_all(query) or []
+
     def remove_entry(self, id):
         query = "DELETE FROM filesystem WHERE id = ?"
         self._db.write(query, (id,))
 
+    def remove_entries(self, ids):
+        query = "DELETE FROM filesystem WHERE id = ?"
+        self._db.write_many(query, [(id,) for id in ids])
+
     def get_largest_id(self):
         query = "SELECT max(id) FROM filesystem"
         return max(self._db.read_one(query)[0] or 0, 0)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+import os
+import struct
+import time
+from threading import Lock
+
+MAGIC = b'MUTR\x01'
+
+OPEN = 0
+READ = 1
+RELEASE = 2
+
+# Every record starts with its type, the wall timestamp and the file handle,
+# the opens continue with the path and the reads with the offset and length
+_HEADER = struct.Struct('<BdQ')
+_PATH_SIZE = struct.Struct('<H')
+_READ = struct.Struct('<QI')
+
+
+class TraceRecorder:
+    def __init__(self, path, buffer_size=1024 * 1024):
+        self._f = open(path, 'ab', buffering=buffer_size)
+        if self._f.tell() == 0:
+            self._f.write(MAGIC)
+        self._lock = Lock()
+
+    def record_open(self, path, fh):
+        data = os.fsencode(path)
+        record = _HEADER.pack(OPEN, time.time(), fh) + _PATH_SIZE.pack(len(data)) + data
+        with self._lock:
+            self._f.write(record)
+
+    def record_read(self, fh, offset, length):
+        record = _HEADER.pack(READ, time.time(), fh) + _READ.pack(offset, length)
+        with self._lock:
+            self._f.write(record)
+
+    def record_release(self, fh):
+        record = _HEADER.pack(RELEASE, time.time(), fh)
+        with self._lock:
+            self._f.write(record)
+
+    def close(self):
+        with self._lock:
+            self._f.close()
+
+
+# Yield (type, ts, fh, path, offset, length) by record
+def read_trace(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"The file '{path}' isn't a trace")
+        while True:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                break
+            type, ts, fh = _HEADER.unpack(header)
+            if type == OPEN:
+                data = f.read(_PATH_SIZE.size)
+                if len(data) < _PATH_SIZE.size:
+                    break
+                size, = _PATH_SIZE.unpack(data)
+                data = f.read(size)
+                if len(data) < size:
+                    break
+                yield (type, ts, fh, os.fsdecode(data), 0, 0)
+            elif type == READ:
+                data = f.read(_READ.size)
+                if len(data) < _READ.size:
+                    break
+                offset, length = _READ.unpack(data)
+                yield (type, ts, fh, None, offset, length)
+            elif type == RELEASE:
+                yield (type, ts, fh, None, 0, 0)
+            else:
+                raise ValueError(f"Unknown record type {type} in '{path}'")
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+from threading import Lock
+
+from .types import ST_KEYS
+
+
+class Node:
+    __slots__ = ('id', 'parent_id', 'path', 'name', 'attrs')
+
+    def __init__(self, id, parent_id, path, name, attrs):
+        self.id = id
+        self.parent_id = parent_id
+        self.path = path
+        self.name = name
+        self.attrs = attrs
+
+
+# In-memory copy of the directory tree stored in the DB. The lookups don't
+# take any lock, only the writers are serialized, so the children lists are
+# replaced by updated copies instead of being modified in place.
+class TreeIndex:
+    def __init__(self):
+        self._lock = Lock()
+        self._by_path = {}
+        self._by_id = {}
+        self._children = {}
+
+    def load(self, storage):
+        with self._lock:
+            self._clear()
+            for id, parent_id, path, name, *attrs in storage.get_tree_entries():
+                node = Node(id, parent_id, path, name, tuple(attrs))
+                self._by_path[path] = node
+                self._by_id[id] = node
+                self._children.setdefault(parent_id, []).append(name)
+            for names in self._children.values():
+                names.sort()
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        self._by_path = {}
+        self._by_id = {}
+        self._children = {}
+
+    def get_attr(self, path):
+        node = self._by_path.get(path)
+        if node is None:
+            return None
+        return dict(zip(ST_KEYS, node.attrs))
+
+    def get_id(self, path):
+        node = self._by_path.get(path)
+        if node is None:
+            return None
+        return node.id
+
+    def get_children_attrs(self, parent_id):
+        parent = self._by_id.get(parent_id)
+        if parent is None:
+            return []
+        prefix = parent.path.rstrip('/') + '/'
+        res = []
+        for name in self._children.get(parent_id, ()):
+            node = self._by_path.get(prefix + name)
+            if node is not None:
+                res.append((name, node.path, dict(zip(ST_KEYS, node.attrs))))
+        return res
+
+    def add_entries(self, entries):
+        with self._lock:
+            # The children lists are copied once per batch, and sorted and
+            # published at the end
+            children = {}
+            for e in entries:
+                attrs = tuple(getattr(e, k) for k in ST_KEYS)
+                self._add(Node(e.id, e.parent_id, e.path, e.name, attrs), children)
+            for names in children.values():
+                names.sort()
+            self._children.update(children)
+
+    def _add(self, node, children):
+        # Mimic the REPLACE of the DB, that drops the rows with the same id or path
+        old = self._by_id.get(node.id)
+        if old is not None:
+            self._unlink(old, children)
+        old = self._by_path.get(node.path)
+        if old is not None:
+            self._unlink(old, children)
+        self._by_path[node.path] = node
+        self._by_id[node.id] = node
+        self._get_children_copy(node.parent_id, children).append(node.name)
+
+    def _get_children_copy(self, parent_id, children):
+        names = children.get(parent_id)
+        if names is None:
+            names = children[parent_id] = list(self._children.get(parent_id, ()))
+        return names
+
+    def remove(self, id):
+        with self._lock:
+            node = self._by_id.get(id)
+            if node is not None:
+                children = {}
+                self._unlink(node, children)
+                self._children.update(children)
+            self._children.pop(id, None)
+
+    def _unlink(self, node, children):
+        self._by_id.pop(node.id, None)
+        if self._by_path.get(node.path) is node:
+            del self._by_path[node.path]
+        if node.parent_id not in children and not self._children.get(node.parent_id):
+            return
+        # The copies can be unsorted until the end of the batch
+        try:
+            self._get_children_copy(node.parent_id, children).remove(node.name)
+        except ValueError:
+            pass
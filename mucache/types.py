@@ -19,7 +19,9 @@ class Entry:
     name: str
     state: State = State.NO_CACHED
     last_access_ts: Optional[int] = None
+    access_count: int = 0
     duration: Optional[int] = None
+    pending_duration: bool = False
 
     st_mode: Optional[int] = None
     st_ino: Optional[int] = None
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+import logging
+from threading import Event, Lock, Thread
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBuffer:
+    # Collect the updates of the access timestamps and states to write them
+    # in a single transaction every `flush_every_sec` or when there are
+    # `max_pending` updates, instead of one transaction by update
+    def __init__(self, storage, flush_every_sec=5, max_pending=256):
+        self._storage = storage
+        self._flush_every_sec = flush_every_sec
+        self._max_pending = max_pending
+
+        self._lock = Lock()
+        self._last_access_ts = {}
+        self._access_counts = {}
+        self._states = {}
+        # The states being written, still pending until the commit
+        self._flushing_states = {}
+        self._flush_lock = Lock()
+
+        self._flush_event = Event()
+        self._stopped = False
+        self._thread = None
+
+    def set_last_access_ts(self, id, ts):
+        with self._lock:
+            self._last_access_ts[id] = ts
+            self._check_pending()
+
+    def touch(self, id, ts):
+        with self._lock:
+            self._last_access_ts[id] = ts
+            self._access_counts[id] = self._access_counts.get(id, 0) + 1
+            self._check_pending()
+
+    def set_state(self, id, old_state, new_state):
+        with self._lock:
+            self._states[id] = (old_state, new_state)
+            self._check_pending()
+
+    def _check_pending(self):
+        if len(self._last_access_ts) + len(self._states) >= self._max_pending:
+            self._flush_event.set()
+
+    def has_pending_state(self, id):
+        with self._lock:
+            return id in self._states or id in self._flushing_states
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                last_access_ts = self._last_access_ts
+                access_counts = self._access_counts
+                states = self._states
+                self._last_access_ts = {}
+                self._access_counts = {}
+                self._states = {}
+                self._flushing_states = states
+            if not last_access_ts and not states:
+                return
+            try:
+                self._storage.update_accesses_and_states(
+                    last_access_ts.items(),
+                    access_counts.items(),
+                    ((id, old, new) for id, (old, new) in states.items()),
+                )
+            except:
+                logger.exception("Error flushing the buffered writes")
+                with self._lock:
+                    for id, ts in last_access_ts.items():
+                        self._last_access_ts.setdefault(id, ts)
+                    for id, n in access_counts.items():
+                        self._access_counts[id] = self._access_counts.get(id, 0) + n
+                    for id, state in states.items():
+                        self._states.setdefault(id, state)
+            finally:
+                with self._lock:
+                    self._flushing_states = {}
+
+    def start(self):
+        self._thread = Thread(target=self._loop)
+        self._thread.start()
+
+    def _loop(self):
+        while not self._stopped:
+            self._flush_event.wait(self._flush_every_sec)
+            self._flush_event.clear()
+            self.flush()
+
+    def stop(self):
+        self._stopped = True
+        self._flush_event.set()
+        self._thread.join()
+        self._thread = None
+        self.flush()